@@ -2,8 +2,6 @@
 #
 # Author: fisher
 #
-# TODO: Update text sensors only when changed
-#
 #
 # v0.1.0 - initial version, fetching data from airly sensor
 # v0.1.1 - response body decode - error handling, minor language corrections
@@ -15,12 +13,37 @@
 # v0.3.1 - add NO2 SO2 O3 and CO measurements (by CHKDSK88)
 # v0.3.2 - rounding percentage values to integer for correct data push to influxdb (by pkilar43)
 # v0.3.3 - compatibility with Python 3.7+ (by tschaban)
+# v0.4.0 - api requests run in a background worker thread, heartbeat never blocks on network
+# v0.4.1 - persistent keep-alive connection to airly api, configurable timeouts (Options field)
+# v0.4.2 - many stations per hardware: list of installation ids or nearest:N query in installation id field
+# v0.4.3 - point (interpolated) and closest installation stations, single api call per poll
+# v0.4.4 - poll interval adapts to api quota left for today (X-RateLimit headers)
+# v0.4.5 - polls aligned to hourly refresh of airly measurements
+# v0.4.6 - response cache with conditional requests, persisted in plugin folder
+# v0.4.7 - installation info cached for days, no api calls for station info on restart
+# v0.4.8 - devices updated only when their value changed
+# v0.4.9 - table driven measurement mapping, NH3 and H2S sensors, devices for new airly parameters
+# v0.5.0 - device registry built once on start, provision option
+# v0.5.1 - measurements archived in SQLite database in plugin folder
+# v0.5.2 - gaps in measurements history filled from airly 24h history
+# v0.5.3 - forecast devices: CAQI in 3/6/12h, max PM2.5 in 24h, hours until pollution level drops
+# v0.5.4 - api_url option, offline airly api simulator in tools folder
+# v0.5.5 - api latency, quota and failure metrics as devices or json file
+# v0.5.6 - exponential backoff with jitter after failed requests, Retry-After, circuit breaker
+# v0.5.7 - shared_dir option: hardware instances share responses and api key quota
+# v0.5.8 - translations resolved once on start, debug messages formatted only in debug mode
+# v0.5.9 - gzip compressed responses, only measurement sections used by enabled features are decoded
+# v0.6.0 - 24h mean PM2.5 and PM10, 8h mean CO, days with PM norms exceeded this year
+# v0.6.1 - rules.json: switches driven by thresholds with hysteresis and rate of change
+# v0.6.2 - fast start: last values and poll schedule restored from snapshot, no api calls on start
+# v0.6.3 - fused stations: airly, GIOS, local HTTP/JSON and MQTT sensors merged per pollutant
 """
-<plugin key="AIRLY" name="domoticz-airly" author="fisher" version="0.3.3" wikilink="https://www.domoticz.com/wiki/Plugins/domoticz-airly.html" externallink="https://github.com/lrybak/domoticz-airly">
+<plugin key="AIRLY" name="domoticz-airly" author="fisher" version="0.6.3" wikilink="https://www.domoticz.com/wiki/Plugins/domoticz-airly.html" externallink="https://github.com/lrybak/domoticz-airly">
     <params>
 		<param field="Mode1" label="Airly API key" default="" width="400px" required="true"  />
-        <param field="Mode2" label="Airly installation id" width="40px" default="" required="true" />
+        <param field="Mode2" label="Airly installation id(s)" width="200px" default="" required="true" />
         <param field="Mode3" label="Check every x minutes" width="40px" default="15" required="true" />
+        <param field="Mode4" label="Options" width="400px" default="" />
 		<param field="Mode6" label="Debug" width="75px">
 			<options>
 				<option label="True" value="Debug"/>
@@ -33,10 +56,31 @@
 import Domoticz
 import datetime
 import json
-from http.client import HTTPSConnection
+from http.client import HTTPConnection, HTTPSConnection, BadStatusLine, ImproperConnectionState
 from urllib.parse import urlparse
 from urllib.parse import urlencode
 import socket
+import math
+import sqlite3
+import os
+import hashlib
+import email.utils
+import calendar
+import random
+import threading
+import queue
+import time
+import contextlib
+import zlib
+import statistics
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows, shared_dir option is disabled
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None  # Optional, mqtt sources of fused stations are disabled
 
 L10N = {
     'pl': {
@@ -88,12 +132,10 @@ L10N = {
             "%(Vendor)s - %(Address)s, %(Locality)s<br/>Sponsor stacji: %(sensorFounder)s",
         "%(Vendor)s - %(Locality)s %(StreetNumber)s<br/>Station founder: %(sensorFounder)s":
             "%(Vendor)s - %(Locality)s %(StreetNumber)s<br/>Sponsor stacji: %(sensorFounder)s",
-        "Sensor id (%(installation_id)d) not exists":
-            "Sensor (%(installation_id)d) nie istnieje",
+        "Sensor id (%(installation_id)s) not exists":
+            "Sensor (%(installation_id)s) nie istnieje",
         "Not authorized":
             "Brak autoryzacji",
-        "Starting device update":
-            "Rozpoczynanie aktualizacji urządzeń",
         "Update unit=%d; nValue=%d; sValue=%s":
             "Aktualizacja unit=%d; nValue=%d; sValue=%s",
         "Bad air today!":
@@ -107,16 +149,187 @@ L10N = {
         "Connection to airly api failed: %s":
             "Połączenie z airly api nie powiodło się: %s",
         "Unrecognized error: %s":
-            "Nierozpoznany błąd: %s"
+            "Nierozpoznany błąd: %s",
+        "Unknown option: %s":
+            "Nieznana opcja: %s",
+        "Invalid value of option %(Key)s: %(Value)s":
+            "Niepoprawna wartość opcji %(Key)s: %(Value)s",
+        "Invalid installation id: %s":
+            "Niepoprawny identyfikator stacji: %s",
+        "Too many stations, only %d stations per hardware are supported":
+            "Zbyt wiele stacji, obsługiwane jest maksymalnie %d stacji na sprzęt",
+        "No airly installation within %(Distance)d km from %(Lat)s, %(Lng)s":
+            "Brak stacji airly w promieniu %(Distance)d km od %(Lat)s, %(Lng)s",
+        "Station %(Index)d: installation id %(Id)d":
+            "Stacja %(Index)d: identyfikator %(Id)d",
+        "Values interpolated for %(Lat)s, %(Lng)s":
+            "Wartości interpolowane dla %(Lat)s, %(Lng)s",
+        "Installation closest to %(Lat)s, %(Lng)s":
+            "Stacja najbliższa %(Lat)s, %(Lng)s",
+        "Quota: %(Remaining)d of %(Limit)s requests left for today, %(Stations)d stations, next poll in %(Interval)d s":
+            "Limit: pozostało %(Remaining)d z %(Limit)s zapytań na dziś, %(Stations)d stacji, następne pobranie za %(Interval)d s",
+        "Station %(Station)s: measurement till %(Till)s, next poll at %(Next)s":
+            "Stacja %(Station)s: pomiar do %(Till)s, następne pobranie o %(Next)s",
+        "Updated %(Updated)d of %(Total)d devices":
+            "Zaktualizowano %(Updated)d z %(Total)d urządzeń",
+        "New airly parameter %(Name)s, adding unit %(Unit)d":
+            "Nowy parametr airly %(Name)s, dodaję urządzenie %(Unit)d",
+        "%(Job)s failed: %(Error)s":
+            "%(Job)s - błąd: %(Error)s",
+        "Filled %d missing hours of measurements history":
+            "Uzupełniono %d brakujących godzin historii pomiarów",
+        "Air Quality Index in 3h":
+            "Jakość powietrza za 3h",
+        "Air Quality Index in 6h":
+            "Jakość powietrza za 6h",
+        "Air Quality Index in 12h":
+            "Jakość powietrza za 12h",
+        "PM2.5 max in 24h":
+            "PM2.5 maks. w ciągu 24h",
+        "Hours until pollution level drops":
+            "Godziny do spadku zanieczyszczenia",
+        "API latency":
+            "Czas odpowiedzi API",
+        "API connect time":
+            "Czas połączenia z API",
+        "API data per poll":
+            "Dane z API na pobranie",
+        "API 429 responses":
+            "Odpowiedzi 429 API",
+        "API quota remaining":
+            "Pozostały limit zapytań API",
+        "Consecutive failures":
+            "Kolejne błędy",
+        "Minutes since last success":
+            "Minuty od ostatniego pobrania",
+        "Airly api %(Endpoint)s keeps failing, requests suspended until %(Time)s":
+            "Airly api %(Endpoint)s nie odpowiada poprawnie, zapytania wstrzymane do %(Time)s",
+        "Option shared_dir is not supported on this system":
+            "Opcja shared_dir nie jest obsługiwana w tym systemie",
+        "PM2.5 24h mean":
+            "PM2.5 średnia 24h",
+        "PM10 24h mean":
+            "PM10 średnia 24h",
+        "CO 8h mean":
+            "CO średnia 8h",
+        "PM2.5 norm exceeded days this year":
+            "Dni z przekroczoną normą PM2.5 w tym roku",
+        "PM10 norm exceeded days this year":
+            "Dni z przekroczoną normą PM10 w tym roku",
+        "Invalid rule %(Index)d in %(File)s: %(Error)s":
+            "Nieprawidłowa reguła %(Index)d w %(File)s: %(Error)s",
+        "Too many rules, only %d rules are supported":
+            "Za dużo reguł, obsługiwanych jest tylko %d reguł",
+        "Rule %s turned on":
+            "Reguła %s włączona",
+        "Rule %s turned off":
+            "Reguła %s wyłączona",
+        "Station %(Name)s: values restored, next poll at %(Next)s":
+            "Stacja %(Name)s: przywrócono wartości, następne zapytanie o %(Next)s",
+        "Airly api request still running on stop":
+            "Zapytanie do airly api nadal trwa podczas zatrzymania",
+        "Invalid sources of %(Name)s in %(File)s: %(Error)s":
+            "Nieprawidłowe źródła %(Name)s w %(File)s: %(Error)s",
+        "Source %(Name)s failed: %(Error)s":
+            "Źródło %(Name)s - błąd: %(Error)s",
+        "Values of %(Count)d sources fused by %(Method)s":
+            "Wartości z %(Count)d źródeł łączone metodą %(Method)s"
     },
     'en': { }
 }
 
+# messages of the Domoticz language, filled on start
+TRANSLATIONS = {}
+DEBUG = False
+
+def setLanguage(language):
+    TRANSLATIONS.clear()
+    TRANSLATIONS.update(L10N.get(language, {}))
+
+def setDebugging(enabled):
+    global DEBUG
+    DEBUG = enabled
+    Domoticz.Debugging(1 if enabled else 0)
+
 def _(key):
+    return TRANSLATIONS.get(key, key)
+
+def debug(message, args=None):
+    """Domoticz.Debug of translated message, not even formatted when debugging is off"""
+
+    if DEBUG:
+        Domoticz.Debug(_(message) % args if args is not None else _(message))
+
+def parseTimestamp(value):
+    """airly UTC timestamp (2019-10-15T10:00:00.000Z) to unix time"""
+
+    utc = datetime.datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+    return calendar.timegm(utc.timetuple())
+
+def parseDateTime(value):
+    """airly UTC timestamp (2019-10-15T10:00:00.000Z) to local naive datetime"""
+
+    return datetime.datetime.fromtimestamp(parseTimestamp(value))
+
+def parseRetryAfter(value):
+    """Retry-After header - seconds or http date, returns seconds to wait or None"""
+
+    if not value:
+        return None
     try:
-        return L10N[Settings["Language"]][key]
-    except KeyError:
-        return key
+        return max(int(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def writeJsonAtomic(path, data, indent=None):
+    """write json through a temporary file replaced in one step, readers never see a partial file
+
+    Raises OSError, callers decide whether the file is optional.
+    """
+
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=indent)
+    os.replace(path + ".tmp", path)
+
+JSON_DECODER = json.JSONDecoder()
+JSON_WHITESPACE = json.decoder.WHITESPACE
+
+def decodeSections(text, sections):
+    """json object with only given top level keys, decoding stops once all of them are found
+
+    airly measurement response starts with current, followed by history and forecast
+    """
+
+    skip = JSON_WHITESPACE.match
+    pos = skip(text, 0).end()
+    if text[pos:pos + 1] != "{":
+        return json.loads(text)
+    result = {}
+    wanted = set(sections)
+    pos += 1
+    while wanted:
+        pos = skip(text, pos).end()
+        if text[pos:pos + 1] == "}":
+            break
+        key, pos = JSON_DECODER.raw_decode(text, pos)
+        pos = skip(text, pos).end()
+        if text[pos:pos + 1] != ":":
+            raise json.JSONDecodeError("Expecting ':' delimiter", text, pos)
+        value, pos = JSON_DECODER.raw_decode(text, skip(text, pos + 1).end())
+        if key in wanted:
+            result[key] = value
+            wanted.discard(key)
+        pos = skip(text, pos).end()
+        if text[pos:pos + 1] == "}":
+            break
+        if text[pos:pos + 1] != ",":
+            raise json.JSONDecodeError("Expecting ',' delimiter", text, pos)
+        pos += 1
+    return result
 
 class UnauthorizedException(Exception):
     def __init__(self, expression, message):
@@ -129,29 +342,1290 @@ class SensorNotFoundException(Exception):
         self.message = message
 
 class TooManyRequestsException(Exception):
-    def __init__(self, expression, message):
+    def __init__(self, expression, message, retryAfter=None):
         self.expression = expression
         self.message = message
+        self.retryAfter = retryAfter
 
 class ConnectionErrorException(Exception):
     def __init__(self, expression, message):
         self.expression = expression
         self.message = message
 
+class ApiErrorException(Exception):
+    def __init__(self, expression, message, retryAfter=None):
+        self.expression = expression
+        self.message = message
+        self.retryAfter = retryAfter
+
+class CircuitOpenException(Exception):
+    def __init__(self, expression, message):
+        self.expression = expression
+        self.message = message
+
+class FetchWorker:
+    """background thread running api requests outside of the Domoticz plugin thread"""
+
+    def __init__(self):
+        self.tasks = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = None
+        # set by stop, jobs check it between requests
+        self.stopping = threading.Event()
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stopping.clear()
+            self.thread = threading.Thread(name="AirlyFetchWorker", target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self, timeout=10):
+        """drop queued jobs and wait for the running one, False when the thread is still alive"""
+
+        self.stopping.set()
+        while True:
+            try:
+                self.tasks.get_nowait()
+            except queue.Empty:
+                break
+            self.tasks.task_done()
+        alive = False
+        if self.thread is not None and self.thread.is_alive():
+            self.tasks.put(None)
+            self.thread.join(timeout)
+            alive = self.thread.is_alive()
+        self.thread = None
+        return not alive
+
+    def submit(self, name, func, *args):
+        """queue job, func is called in the worker thread and must not touch Domoticz API"""
+        self.tasks.put((name, func, args))
+
+    def poll(self):
+        """finished jobs as (name, result, error) tuples, never blocks"""
+        while True:
+            try:
+                yield self.results.get_nowait()
+            except queue.Empty:
+                return
+
+    def wait(self):
+        """block until all queued jobs are done, for tools driving the plugin outside Domoticz"""
+
+        self.tasks.join()
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                self.tasks.task_done()
+                break
+            name, func, args = task
+            try:
+                self.results.put((name, func(*args), None))
+            except Exception as e:
+                self.results.put((name, None, e))
+            finally:
+                self.tasks.task_done()
+
+class HttpClient:
+    """keep-alive connection pool, one persistent connection per host"""
+
+    def __init__(self, connectTimeout=10, readTimeout=30, maxIdle=60, metrics=None):
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        # servers drop idle keep-alive sockets, don't bother writing to old ones; with polls
+        # minutes apart only requests of one poll (stations, installation info) share a connection
+        self.maxIdle = maxIdle
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        # closed client opens no new connections
+        self.closed = False
+
+    def connection(self, scheme, netloc):
+        """pooled connection for host and a flag whether it was reused"""
+
+        key = (scheme, netloc)
+        if key in self.connections:
+            conn, lastUsed = self.connections[key]
+            if time.monotonic() - lastUsed < self.maxIdle:
+                return conn, True
+            self.discard(key)
+
+        if scheme == "https":
+            conn = HTTPSConnection(netloc, timeout=self.connectTimeout)
+        else:
+            conn = HTTPConnection(netloc, timeout=self.connectTimeout)
+        started = time.monotonic()
+        conn.connect()
+        if self.metrics is not None:
+            # TCP and TLS handshake
+            self.metrics.connected(time.monotonic() - started)
+        conn.sock.settimeout(self.readTimeout)
+        self.connections[key] = (conn, time.monotonic())
+        return conn, False
+
+    def discard(self, key):
+        conn, lastUsed = self.connections.pop(key, (None, None))
+        if conn is not None:
+            conn.close()
+
+    def request(self, method, url, headers=None):
+        """send request, returns (status, headers, body)"""
+
+        url = urlparse(url)
+        key = (url.scheme, url.netloc)
+        path = url.path + ("?" + url.query if url.query else "")
+
+        with self.lock:
+            while True:
+                if self.closed:
+                    raise ConnectionError("http client is closed")
+                conn, reused = self.connection(*key)
+                try:
+                    conn.request(method=method, url=path, headers=headers or {})
+                    response = conn.getresponse()
+                    body = self.read(response)
+                except (ConnectionError, BadStatusLine, ImproperConnectionState):
+                    self.discard(key)
+                    # server closed idle socket, retry once on a fresh connection
+                    if reused:
+                        continue
+                    raise
+                except Exception:
+                    self.discard(key)
+                    raise
+
+                if response.will_close or self.closed:
+                    self.discard(key)
+                else:
+                    self.connections[key] = (conn, time.monotonic())
+                return response.status, response.msg, body
+
+    def read(self, response, chunkSize=16384):
+        """response body read in chunks, gzip content is decompressed as it arrives"""
+
+        decompressor = None
+        if (response.getheader("Content-Encoding") or "").lower() == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = []
+        size = 0
+        while True:
+            chunk = response.read(chunkSize)
+            if not chunk:
+                break
+            size += len(chunk)
+            chunks.append(decompressor.decompress(chunk) if decompressor is not None else chunk)
+        if decompressor is not None:
+            chunks.append(decompressor.flush())
+        if self.metrics is not None:
+            self.metrics.received(size)
+        return b"".join(chunks)
+
+    def close(self):
+        """close pooled connections, a request in flight closes its own when done"""
+
+        self.closed = True
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            for key in list(self.connections.keys()):
+                self.discard(key)
+        finally:
+            self.lock.release()
+
+class Metrics:
+    """request and poll statistics of the hardware, updated from the worker and plugin threads"""
+
+    # upper bounds of latency histogram buckets in ms, the last bucket is unbounded
+    BUCKETS = [50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+        self.latency = 0.0
+        self.status = {}
+        self.bytes = 0
+        self.connects = 0
+        self.connectTime = 0.0
+        self.tooManyRequests = 0
+        self.failures = 0
+        self.lastSuccess = None
+        # requests, latency, connects, connect time and bytes since last publish
+        self.window = [0, 0.0, 0, 0.0, 0]
+
+    def connected(self, seconds):
+        with self.lock:
+            self.connects += 1
+            self.connectTime += seconds
+            self.window[2] += 1
+            self.window[3] += seconds
+
+    def received(self, size):
+        """bytes transferred, compressed size of gzip responses"""
+
+        with self.lock:
+            self.bytes += size
+            self.window[4] += size
+
+    def request(self, status, seconds):
+        """status is None when no response was received"""
+
+        ms = seconds * 1000
+        with self.lock:
+            self.requests += 1
+            bucket = 0
+            while bucket < len(self.BUCKETS) and ms > self.BUCKETS[bucket]:
+                bucket += 1
+            self.histogram[bucket] += 1
+            self.latency += seconds
+            key = str(status) if status is not None else "error"
+            self.status[key] = self.status.get(key, 0) + 1
+            if status == 429:
+                self.tooManyRequests += 1
+            self.window[0] += 1
+            self.window[1] += seconds
+
+    def polled(self, success):
+        """result of a single api request applied in the plugin thread"""
+
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.lastSuccess = time.time()
+            else:
+                self.failures += 1
+
+    def percentile(self, fraction):
+        """upper bound of histogram bucket with given fraction of requests, None for the unbounded one"""
+
+        total = sum(self.histogram)
+        if not total:
+            return None
+        count = 0
+        for bucket, n in enumerate(self.histogram):
+            count += n
+            if count >= total * fraction:
+                return self.BUCKETS[bucket] if bucket < len(self.BUCKETS) else None
+
+    def snapshot(self, quota):
+        """metrics since start and averages since previous snapshot"""
+
+        with self.lock:
+            requests, latency, connects, connectTime, size = self.window
+            self.window = [0, 0.0, 0, 0.0, 0]
+            limitDay, remainingDay, limitMinute, remainingMinute = quota.snapshot()
+            now = time.time()
+            return {
+                "time":                 now,
+                "requests":             self.requests,
+                "status":               dict(self.status),
+                "latency_histogram_ms": dict(zip([str(bound) for bound in self.BUCKETS] + ["inf"], self.histogram)),
+                "latency_p50_ms":       self.percentile(0.5),
+                "latency_p95_ms":       self.percentile(0.95),
+                "latency_ms":           self.latency / self.requests * 1000 if self.requests else None,
+                "poll_latency_ms":      latency / requests * 1000 if requests else None,
+                "connects":             self.connects,
+                "connect_ms":           self.connectTime / self.connects * 1000 if self.connects else None,
+                "poll_connect_ms":      connectTime / connects * 1000 if connects else None,
+                "bytes":                self.bytes,
+                "poll_bytes":           size,
+                "too_many_requests":    self.tooManyRequests,
+                "quota_limit_day":      limitDay,
+                "quota_remaining_day":  remainingDay,
+                "quota_remaining_minute": remainingMinute,
+                "consecutive_failures": self.failures,
+                "last_success":         self.lastSuccess,
+                "last_success_age_s":   now - (self.lastSuccess or self.started),
+            }
+
+class Backoff:
+    """retry delays after failed requests, exponential per error class, used in the plugin thread only"""
+
+    # error class: (first delay, max delay) in seconds
+    DELAYS = {
+        "connection":   (60, 3600),
+        "server":       (120, 3600),
+        "quota":        (60, 86400),
+        "unauthorized": (3600, 86400),
+        "not_found":    (900, 21600),
+    }
+
+    def __init__(self):
+        # station or "api" for api key wide errors: consecutive failures
+        self.attempts = {}
+
+    def delay(self, key, errorClass, minimum=0):
+        attempt = self.attempts.get(key, 0)
+        self.attempts[key] = attempt + 1
+        first, cap = self.DELAYS[errorClass]
+        ceiling = min(first * 2 ** min(attempt, 16), cap)
+        # random half of the delay keeps hardware instances sharing an outage from retrying in lockstep
+        return max(minimum, random.uniform(ceiling / 2.0, ceiling))
+
+    def reset(self, key):
+        self.attempts.pop(key, None)
+
+class CircuitBreaker:
+    """stops requests to an endpoint failing with connection or server errors, then probes it with a single request
+
+    closed - requests pass, threshold consecutive failures open the circuit
+    open - requests fail right away until timeout passes
+    half-open - one probe request passes, success closes the circuit, failure opens it with doubled timeout
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=5, timeout=300, maxTimeout=3600):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.maxTimeout = maxTimeout
+        self.lock = threading.Lock()
+        # endpoint: [state, consecutive failures, open until, current timeout]
+        self.circuits = {}
+
+    def circuit(self, endpoint):
+        return self.circuits.setdefault(endpoint, [self.CLOSED, 0, 0, self.timeout])
+
+    def allow(self, endpoint):
+        with self.lock:
+            circuit = self.circuit(endpoint)
+            if circuit[0] == self.CLOSED:
+                return True
+            if circuit[0] == self.OPEN and time.time() >= circuit[2]:
+                # this request is the probe, others wait for its result
+                circuit[0] = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self, endpoint):
+        with self.lock:
+            self.circuits[endpoint] = [self.CLOSED, 0, 0, self.timeout]
+
+    def failure(self, endpoint):
+        with self.lock:
+            circuit = self.circuit(endpoint)
+            circuit[1] += 1
+            if circuit[0] == self.HALF_OPEN:
+                circuit[3] = min(circuit[3] * 2, self.maxTimeout)
+            elif circuit[1] < self.threshold:
+                return
+            circuit[0] = self.OPEN
+            circuit[2] = time.time() + circuit[3]
+
+    def retryAt(self, endpoint):
+        """unix time the endpoint gets probed"""
+
+        with self.lock:
+            return self.circuit(endpoint)[2]
+
+class ResponseCache:
+    """GET response cache with conditional requests, entries are persisted as json files in folder"""
+
+    def __init__(self, folder=None):
+        self.folder = folder
+        # folder written by other hardware too, entries are reloaded when their file changes
+        self.shared = False
+        self.entries = {}
+        self.mtimes = {}
+        self.lock = threading.Lock()
+
+    def path(self, url):
+        return os.path.join(self.folder, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, url):
+        """cached entry or None, loaded from disk on first use"""
+
+        with self.lock:
+            if self.shared and url in self.entries:
+                try:
+                    if os.stat(self.path(url)).st_mtime != self.mtimes.get(url):
+                        del self.entries[url]
+                except OSError:
+                    pass  # Not cached yet
+            if url not in self.entries:
+                self.entries[url] = None
+                if self.folder:
+                    try:
+                        with open(self.path(url), encoding="utf-8") as f:
+                            self.mtimes[url] = os.fstat(f.fileno()).st_mtime
+                            self.entries[url] = json.load(f)
+                    except (OSError, ValueError):
+                        pass  # Not cached yet
+            return self.entries[url]
+
+    @staticmethod
+    def fresh(entry, maxAge=None):
+        """entry valid per http headers or younger than maxAge seconds"""
+
+        if maxAge is not None and time.time() - entry.get("stored", 0) < maxAge:
+            return True
+        return entry["expires"] is not None and time.time() < entry["expires"]
+
+    @staticmethod
+    def validators(entry):
+        """conditional request headers"""
+
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["lastModified"]:
+            headers["If-Modified-Since"] = entry["lastModified"]
+        return headers
+
+    @staticmethod
+    def expires(headers):
+        """expiry timestamp from Cache-Control or Expires headers, None when response must be revalidated"""
+
+        cacheControl = [item.strip().lower() for item in (headers.get("Cache-Control") or "").split(",")]
+        if "no-cache" in cacheControl:
+            return None
+        for item in cacheControl:
+            if item.startswith("max-age="):
+                try:
+                    return time.time() + int(item[8:])
+                except ValueError:
+                    return None
+        try:
+            return email.utils.parsedate_to_datetime(headers.get("Expires")).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    def store(self, url, headers, body):
+        if "no-store" in (headers.get("Cache-Control") or "").lower():
+            return
+        self.save(url, {
+            "body":         body,
+            "etag":         headers.get("ETag"),
+            "lastModified": headers.get("Last-Modified"),
+            "expires":      self.expires(headers),
+            "stored":       time.time(),
+        })
+
+    def revalidated(self, url, entry, headers):
+        """304 response - entry is still valid, refresh its expiry"""
+
+        entry = dict(entry)
+        entry["expires"] = self.expires(headers)
+        entry["etag"] = headers.get("ETag") or entry["etag"]
+        entry["stored"] = time.time()
+        self.save(url, entry)
+
+    def save(self, url, entry):
+        with self.lock:
+            self.entries[url] = entry
+            if not self.folder:
+                return
+            try:
+                # many hardware instances share the plugin folder, replace file atomically
+                path = self.path(url)
+                writeJsonAtomic(path, entry)
+                self.mtimes[url] = os.stat(path).st_mtime
+            except OSError:
+                pass  # Cache is optional
+
+class Coordinator:
+    """hardware instances sharing a folder: one request per url at a time and common quota of api key
+
+    Locks are flock()ed files, they work across Domoticz processes and between hardware of one Domoticz.
+    """
+
+    # hardware not seen for this many seconds no longer takes its share of the quota
+    EXPIRE = 2 * 86400
+
+    def __init__(self, folder, apikey, instance):
+        self.folder = folder
+        self.instance = str(instance)
+        self.path = os.path.join(folder, "quota-%s.json" % hashlib.sha1(apikey.encode("utf-8")).hexdigest()[:12])
+        self.stations = []
+        os.makedirs(os.path.join(folder, "locks"), exist_ok=True)
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        path = os.path.join(self.folder, "locks", hashlib.sha1(name.encode("utf-8")).hexdigest() + ".lock")
+        with open(path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def share(self, quota=None, stations=None):
+        """publish quota seen by this hardware and its station names to the api key file"""
+
+        if stations is not None:
+            self.stations = stations
+        with self.lock(self.path):
+            state = self.read()
+            now = time.time()
+            if quota is not None and quota.updated > state.get("updated", 0):
+                state["quota"] = quota.snapshot()
+                state["updated"] = quota.updated
+            instances = state.get("instances", {})
+            instances[self.instance] = {"stations": self.stations, "seen": now}
+            state["instances"] = dict((key, value) for key, value in instances.items() if now - value["seen"] < self.EXPIRE)
+            try:
+                writeJsonAtomic(self.path, state)
+            except OSError:
+                pass  # Instances poll on their own quota then
+
+    def sync(self, quota):
+        """take newer quota of the api key, returns number of distinct stations polled with it"""
+
+        state = self.read()
+        if "quota" in state:
+            quota.merge(state["quota"], state["updated"])
+        stations = set(self.stations)
+        now = time.time()
+        for instance in state.get("instances", {}).values():
+            if now - instance["seen"] < self.EXPIRE:
+                stations.update(instance["stations"])
+        return len(stations)
+
+class HistoryStore:
+    """measurements archive in a SQLite database, readable without Domoticz
+
+    measurements - hourly values, one row per station, period start (unix time, UTC) and parameter
+    daily - daily mean, min and max of measurements older than retention days
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS measurements (
+            station TEXT NOT NULL,
+            time INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            value REAL,
+            PRIMARY KEY (station, time, name)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS daily (
+            station TEXT NOT NULL,
+            day TEXT NOT NULL,
+            name TEXT NOT NULL,
+            mean REAL,
+            min REAL,
+            max REAL,
+            samples INTEGER,
+            PRIMARY KEY (station, day, name)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path, retention=30, dailyRetention=0):
+        self.path = path
+        self.retention = retention
+        self.dailyRetention = dailyRetention
+        self.db = None
+        self.lock = threading.Lock()
+        self.maintained = None
+
+    def open(self):
+        if self.db is None:
+            # database is shared by all hardware instances, wait for their writes
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    @staticmethod
+    def rows(station, measurement):
+        """rows of an airly measurement block (current or history item)"""
+
+        time = parseTimestamp(measurement["fromDateTime"])
+        rows = []
+        for item in measurement.get("values", []) + measurement.get("indexes", []):
+            if "name" in item and "value" in item:
+                rows.append((station, time, item["name"], item["value"]))
+        return rows
+
+    def add(self, station, measurements, history=()):
+        """store measurement blocks of a station, newer data replaces the same period
+
+        history - airly hourly history, only periods missing in the store are added
+        returns number of backfilled periods
+        """
+
+        rows = []
+        for measurement in measurements:
+            rows.extend(self.rows(station, measurement))
+        with self.lock:
+            self.open()
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO measurements VALUES (?, ?, ?, ?)", rows)
+                filled = self.backfill(station, history)
+            self.maintain()
+        return filled
+
+    def backfill(self, station, history):
+        """add history periods with values the store has no rows for"""
+
+        history = [measurement for measurement in history if measurement.get("values")]
+        if not history:
+            return 0
+
+        times = [parseTimestamp(measurement["fromDateTime"]) for measurement in history]
+        known = set(row[0] for row in self.db.execute(
+            "SELECT DISTINCT time FROM measurements WHERE station = ? AND time BETWEEN ? AND ?",
+            (station, min(times), max(times))
+        ))
+        rows = []
+        filled = 0
+        for time, measurement in zip(times, history):
+            if time not in known:
+                rows.extend(self.rows(station, measurement))
+                filled += 1
+        self.db.executemany("INSERT OR IGNORE INTO measurements VALUES (?, ?, ?, ?)", rows)
+        return filled
+
+    def maintain(self):
+        """once a day move measurements older than retention days to daily table"""
+
+        today = datetime.datetime.utcnow().date()
+        if self.retention <= 0 or self.maintained == today:
+            return
+        self.maintained = today
+
+        cutoff = calendar.timegm((today - datetime.timedelta(days=self.retention)).timetuple())
+        with self.db:
+            self.db.execute("""
+                INSERT OR REPLACE INTO daily
+                SELECT station, date(time, 'unixepoch'), name, avg(value), min(value), max(value), count(value)
+                FROM measurements WHERE time < ? GROUP BY 1, 2, 3
+            """, (cutoff,))
+            self.db.execute("DELETE FROM measurements WHERE time < ?", (cutoff,))
+            if self.dailyRetention > 0:
+                self.db.execute("DELETE FROM daily WHERE day < ?", (
+                    (today - datetime.timedelta(days=self.dailyRetention)).isoformat(),
+                ))
+
+class RateLimit:
+    """airly api quota as reported by X-RateLimit-* response headers, daily limit resets at midnight UTC"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limitDay = None
+        self.remainingDay = None
+        self.limitMinute = None
+        self.remainingMinute = None
+        self.updated = 0
+
+    def update(self, headers):
+        """called from the worker thread for every response, returns True when headers carried quota"""
+
+        def header(name):
+            try:
+                return int(headers.get(name))
+            except (TypeError, ValueError):
+                return None
+
+        remainingDay = header("X-RateLimit-Remaining-day")
+        if remainingDay is None:
+            # not every response carries quota headers, keep the last known state
+            return
+        with self.lock:
+            self.limitDay = header("X-RateLimit-Limit-day")
+            self.remainingDay = remainingDay
+            self.limitMinute = header("X-RateLimit-Limit-minute")
+            self.remainingMinute = header("X-RateLimit-Remaining-minute")
+            self.updated = time.time()
+        return True
+
+    def merge(self, snapshot, updated):
+        """quota reported to another hardware sharing the api key, taken when newer"""
+
+        with self.lock:
+            if updated > self.updated:
+                self.limitDay, self.remainingDay, self.limitMinute, self.remainingMinute = snapshot
+                self.updated = updated
+
+    def snapshot(self):
+        with self.lock:
+            return self.limitDay, self.remainingDay, self.limitMinute, self.remainingMinute
+
+    @staticmethod
+    def secondsToReset():
+        now = datetime.datetime.utcnow()
+        reset = datetime.datetime(now.year, now.month, now.day) + datetime.timedelta(days=1)
+        return (reset - now).total_seconds()
+
+class RollingMean:
+    """mean of hourly values over the last size hours kept in a ring buffer, O(1) per value
+
+    With norm, calendar days with mean above it are collected as exceedance days.
+    Hours are counted from unix epoch, hour h covers h * 3600 ... (h + 1) * 3600.
+    """
+
+    # share of hours needed for a valid mean, 18 of 24 like in EU air quality rules
+    COVERAGE = 0.75
+
+    def __init__(self, size, norm=None):
+        self.size = size
+        self.norm = norm
+        self.hours = [None] * size
+        self.values = [None] * size
+        self.total = 0.0
+        self.count = 0
+        self.latest = None
+        self.exceedances = set()
+
+    @staticmethod
+    def day(hour):
+        return datetime.datetime.fromtimestamp(hour * 3600).date().isoformat()
+
+    def clear(self, slot):
+        if self.values[slot] is not None:
+            self.total -= self.values[slot]
+            self.count -= 1
+            self.values[slot] = None
+            self.hours[slot] = None
+            if not self.count:
+                self.total = 0.0  # Drop accumulated rounding errors
+
+    def add(self, hour, value):
+        if self.latest is not None:
+            if hour <= self.latest - self.size:
+                return  # Older than the window
+            if hour > self.latest:
+                if self.norm is not None and self.day(hour) != self.day(self.latest):
+                    self.closeDay(self.day(self.latest))
+                # slots of skipped hours hold values from before the window
+                for skipped in range(max(self.latest + 1, hour - self.size + 1), hour):
+                    self.clear(skipped % self.size)
+                self.latest = hour
+        else:
+            self.latest = hour
+        slot = hour % self.size
+        self.clear(slot)
+        self.hours[slot] = hour
+        self.values[slot] = value
+        self.total += value
+        self.count += 1
+
+    def closeDay(self, day):
+        """day ended, buffer of 24 hours holds all of its values"""
+
+        values = [value for hour, value in zip(self.hours, self.values) if hour is not None and self.day(hour) == day]
+        if len(values) >= 24 * self.COVERAGE and sum(values) / len(values) > self.norm:
+            self.exceedances.add(day)
+
+    def mean(self):
+        """None until enough hours are known"""
+
+        if self.count < self.size * self.COVERAGE:
+            return None
+        return self.total / self.count
+
+    def exceeded(self, year):
+        return len([day for day in self.exceedances if day.startswith(year)])
+
+    def state(self):
+        # days of the last two years are enough for the current year counter
+        year = datetime.datetime.now().year
+        return {
+            "hours": self.hours,
+            "values": self.values,
+            "latest": self.latest,
+            "exceedances": sorted(day for day in self.exceedances if int(day[:4]) >= year - 1),
+        }
+
+    def restore(self, state):
+        if len(state.get("hours", [])) != self.size:
+            return
+        self.hours = list(state["hours"])
+        self.values = list(state["values"])
+        self.latest = state["latest"]
+        known = [value for value in self.values if value is not None]
+        self.total = float(sum(known))
+        self.count = len(known)
+        self.exceedances = set(state.get("exceedances", []))
+
+class Rule:
+    """switch driven by a measured value: threshold with hysteresis and rate of change
+
+    Turns on when value goes above `above` or rises by at least `rise` per hour,
+    turns off when value drops below `below` (defaults to `above`) and is not rising.
+    Without station the highest value of all stations is compared with the limits
+    and the rule is rising when any station rises.
+    """
+
+    def __init__(self, unit, spec):
+        self.unit = unit
+        self.name = spec["name"]
+        self.value = spec["value"]
+        self.station = str(spec["station"]) if spec.get("station") is not None else None
+        self.above = spec.get("above")
+        self.below = spec.get("below", self.above)
+        self.rise = spec.get("rise")
+        if not isinstance(self.name, str) or not isinstance(self.value, str):
+            raise ValueError("name and value must be strings")
+        for limit in (self.above, self.below, self.rise):
+            if limit is not None and (isinstance(limit, bool) or not isinstance(limit, (int, float))):
+                raise ValueError("above, below and rise must be numbers")
+        if self.above is None and self.rise is None:
+            raise ValueError("above or rise is required")
+        if self.above is not None and self.below is not None and self.below > self.above:
+            raise ValueError("below is greater than above")
+        self.on = False
+        # station name: unix time and value of the last measurement, station name: rate of change per hour
+        self.last = {}
+        self.rate = {}
+
+    def evaluate(self, measured):
+        """state for (station name, value, unix time) list, rates change only with a new measurement of the station"""
+
+        for station, value, at in measured:
+            last = self.last.get(station)
+            if last is not None and at > last[0]:
+                self.rate[station] = (value - last[1]) * 3600.0 / (at - last[0])
+            if last is None or at > last[0]:
+                self.last[station] = (at, value)
+        threshold = self.below if self.on else self.above
+        high = threshold is not None and max(value for station, value, at in measured) > threshold
+        rising = self.rise is not None and any(station in self.rate and self.rate[station] >= self.rise
+                                               for station, value, at in measured)
+        return high or rising
+
+def formatTimestamp(value):
+    """unix time to airly UTC timestamp"""
+
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(value))
+
+def distance(lat1, lng1, lat2, lng2):
+    """great circle distance in km"""
+
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(min(a, 1.0)))
+
+def lookup(document, path):
+    """value at dotted path of decoded json, list items by index, e.g. sensors.0.pm25"""
+
+    for key in path.split("."):
+        if isinstance(document, list):
+            document = document[int(key)]
+        else:
+            document = document[key]
+    return document
+
+class Reading:
+    """values of one source measured at unix time at"""
+
+    def __init__(self, at, values, indexes=None, lat=None, lng=None):
+        self.at = at
+        # airly value name: value
+        self.values = values
+        # airly indexes, only airly sources have them
+        self.indexes = indexes or []
+        # None when location of the source is unknown
+        self.lat = lat
+        self.lng = lng
+
+class Source:
+    """measurement source of a fused station, read() runs in its own thread and returns Reading"""
+
+    def __init__(self, spec, timeout):
+        self.name = str(spec.get("name", spec["type"]))
+        self.lat = spec.get("lat")
+        self.lng = spec.get("lng")
+        self.timeout = timeout
+        # read() of previous poll did not return yet
+        self.busy = False
+        # thread of the last read(), joined on plugin stop
+        self.thread = None
+        # set on plugin stop, read() sends no more requests
+        self.stopping = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def join(self, timeout):
+        """wait for running read(), False when it did not finish in time"""
+
+        if self.thread is not None:
+            self.thread.join(timeout)
+            return not self.thread.is_alive()
+        return True
+
+    def checkStopping(self):
+        if self.stopping:
+            raise ConnectionErrorException(self.name, "plugin is stopping")
+
+class AirlySource(Source):
+    """airly installation, requests go through plugin cache, quota and circuit breaker"""
+
+    def __init__(self, spec, timeout, plugin):
+        Source.__init__(self, spec, timeout)
+        self.plugin = plugin
+        self.id = int(spec["installation"])
+        if "name" not in spec:
+            self.name = "airly %d" % self.id
+
+    def read(self):
+        self.checkStopping()
+        current = self.plugin.installation_measurement(self.id)["current"]
+        values = dict((item["name"], item["value"]) for item in current.get("values", [])
+                      if "name" in item and isinstance(item.get("value"), (int, float)))
+        if self.lat is None and not self.stopping:
+            try:
+                # installation info is cached for info_ttl days
+                location = self.plugin.installation_info(self.id)["location"]
+                self.lat, self.lng = location["latitude"], location["longitude"]
+            except Exception:
+                pass  # Location is needed by weighted fusion only
+        return Reading(parseTimestamp(current["tillDateTime"]), values, current.get("indexes"), self.lat, self.lng)
+
+class JsonSource(Source):
+    """source read over http with its own connection, a slow server doesn't block airly requests"""
+
+    def __init__(self, spec, timeout):
+        Source.__init__(self, spec, timeout)
+        self.client = HttpClient(connectTimeout=timeout, readTimeout=timeout)
+
+    def get(self, url):
+        self.checkStopping()
+        status, headers, body = self.client.request("GET", url, headers={
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip",
+        })
+        if status != 200:
+            raise ApiErrorException(status, "HTTP %d %s" % (status, url))
+        return json.loads(body.decode("utf-8"))
+
+    def stop(self):
+        self.client.close()
+
+class GiosSource(JsonSource):
+    """GIOS (Polish Chief Inspectorate of Environmental Protection) station, public api without key"""
+
+    URL = "https://api.gios.gov.pl/pjp-api/v1/rest"
+    # GIOS indicator code: airly value name, all values are in µg/m³ like in airly
+    CODES = {
+        "PM2.5":    "PM25",
+        "PM10":     "PM10",
+        "NO2":      "NO2",
+        "O3":       "O3",
+        "SO2":      "SO2",
+        "CO":       "CO",
+        "C6H6":     "C6H6",
+    }
+    # station sensors rarely change
+    SENSORS_TTL = 86400
+
+    def __init__(self, spec, timeout):
+        JsonSource.__init__(self, spec, timeout)
+        self.id = int(spec["station"])
+        self.url = spec.get("url", self.URL).rstrip("/")
+        if "name" not in spec:
+            self.name = "gios %d" % self.id
+        self.sensors = None
+        self.sensorsUpdated = 0
+
+    @staticmethod
+    def items(response, key):
+        # api v1 wraps lists in objects with Polish keys, legacy api returned plain lists
+        return response.get(key, []) if isinstance(response, dict) else response
+
+    def read(self):
+        if self.sensors is None or time.time() - self.sensorsUpdated > self.SENSORS_TTL:
+            self.sensors = []
+            for item in self.items(self.get("%s/station/sensors/%d" % (self.url, self.id)), "Lista stanowisk pomiarowych dla podanej stacji"):
+                code = item.get("Wskaźnik - kod") or item.get("param", {}).get("paramCode")
+                sensorId = item.get("Identyfikator stanowiska", item.get("id"))
+                if code and sensorId is not None:
+                    self.sensors.append((code, sensorId))
+            self.sensorsUpdated = time.time()
+
+        values = {}
+        at = None
+        for code, sensorId in self.sensors:
+            name = self.CODES.get(code, code.replace(".", ""))
+            response = self.get("%s/data/getData/%d" % (self.url, sensorId))
+            data = self.items(response, "Lista danych pomiarowych")
+            if isinstance(response, dict) and "values" in response:
+                data = response["values"]
+            # newest hour with a value, times are local (Polish) time
+            latest = max(((item.get("Data", item.get("date")), item.get("Wartość", item.get("value"))) for item in data
+                          if item.get("Wartość", item.get("value")) is not None), default=None)
+            if latest is None:
+                continue
+            values[name] = latest[1]
+            measured = time.mktime(time.strptime(latest[0][:19], "%Y-%m-%d %H:%M:%S"))
+            at = measured if at is None else max(at, measured)
+        if at is None:
+            raise SensorNotFoundException(self.name, "no measurements")
+        return Reading(at, values, lat=self.lat, lng=self.lng)
+
+class HttpSource(JsonSource):
+    """local sensor serving json, values maps airly value names to dotted paths in it"""
+
+    def __init__(self, spec, timeout):
+        JsonSource.__init__(self, spec, timeout)
+        self.url = spec["url"]
+        self.values = dict(spec["values"])
+        # dotted path of unix time of the measurement, time of the request when not given
+        self.time = spec.get("time")
+
+    def read(self):
+        document = self.get(self.url)
+        values = {}
+        for name, path in self.values.items():
+            try:
+                values[name] = float(lookup(document, path))
+            except (KeyError, IndexError, TypeError, ValueError):
+                continue  # Sensor does not report this value right now
+        at = float(lookup(document, self.time)) if self.time else time.time()
+        return Reading(at, values, lat=self.lat, lng=self.lng)
+
+class MqttSource(Source):
+    """local sensor publishing json to mqtt broker, read() returns the last message"""
+
+    def __init__(self, spec, timeout):
+        if mqtt is None:
+            raise ValueError("mqtt source requires paho-mqtt package")
+        Source.__init__(self, spec, timeout)
+        self.host = spec.get("host", "localhost")
+        self.port = int(spec.get("port", 1883))
+        self.topic = spec["topic"]
+        self.values = dict(spec["values"])
+        self.username = spec.get("username")
+        self.password = spec.get("password")
+        self.client = None
+        # unix time and decoded payload of the last message
+        self.message = None
+
+    def start(self):
+        if hasattr(mqtt, "CallbackAPIVersion"):
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        else:
+            self.client = mqtt.Client()
+        if self.username:
+            self.client.username_pw_set(self.username, self.password)
+        self.client.on_connect = self.onConnect
+        self.client.on_message = self.onMessage
+        self.client.connect_async(self.host, self.port)
+        self.client.loop_start()
+
+    def stop(self):
+        if self.client is not None:
+            self.client.loop_stop()
+            self.client.disconnect()
+
+    def onConnect(self, client, *args):
+        # subscribed again after every reconnect
+        client.subscribe(self.topic)
+
+    def onMessage(self, client, userdata, message):
+        try:
+            self.message = (time.time(), json.loads(message.payload.decode("utf-8")))
+        except ValueError:
+            pass  # Not a json payload
+
+    def read(self):
+        if self.message is None:
+            raise ConnectionErrorException(self.name, "no message on %s" % self.topic)
+        at, document = self.message
+        values = {}
+        for name, path in self.values.items():
+            try:
+                values[name] = float(lookup(document, path))
+            except (KeyError, IndexError, TypeError, ValueError):
+                continue
+        return Reading(at, values, lat=self.lat, lng=self.lng)
+
+def readSources(sources, timeout):
+    """read all sources in parallel threads, returns readings and (source name, exception) of failed ones
+
+    Sources not done within timeout are left out, their thread finishes in background
+    and the source is skipped until then.
+    """
+
+    results = {}
+
+    def read(source):
+        try:
+            results[source] = (source.read(), None)
+        except Exception as e:
+            results[source] = (None, e)
+        finally:
+            source.busy = False
+
+    threads = []
+    for source in sources:
+        if source.busy:
+            results[source] = (None, ConnectionErrorException(source.name, "previous request still running"))
+            continue
+        source.busy = True
+        thread = source.thread = threading.Thread(target=read, args=(source,), name="source %s" % source.name, daemon=True)
+        thread.start()
+        threads.append((source, thread))
+
+    deadline = time.monotonic() + timeout
+    for source, thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+        if source not in results:
+            results[source] = (None, ConnectionErrorException(source.name, "no response in %d s" % timeout))
+
+    readings, errors = [], []
+    for source in sources:
+        reading, error = results[source]
+        if error is not None:
+            errors.append((source.name, error))
+        else:
+            readings.append(reading)
+    return readings, errors
+
+def fuse(readings, method, lat, lng):
+    """single value per airly value name from readings of many sources
+
+    freshest - value of the newest reading
+    median - median of all readings
+    weighted - inverse distance weighted mean, readings without location are left out
+    """
+
+    candidates = {}
+    for reading in readings:
+        for name, value in reading.values.items():
+            candidates.setdefault(name, []).append((reading, value))
+
+    values = {}
+    for name, items in candidates.items():
+        if method == "freshest":
+            values[name] = max(items, key=lambda item: item[0].at)[1]
+            continue
+        located = [(reading, value) for reading, value in items if reading.lat is not None and reading.lng is not None]
+        if method == "weighted" and located:
+            # sensor next door counts like one 100 m away, not infinitely
+            weights = [(1.0 / max(distance(lat, lng, reading.lat, reading.lng), 0.1) ** 2, value) for reading, value in located]
+            values[name] = sum(weight * value for weight, value in weights) / sum(weight for weight, value in weights)
+        else:
+            values[name] = statistics.median(value for reading, value in items)
+    return values
+
+class Station:
+    """measurement source polled by the plugin, owns a block of Domoticz units
+
+    kind is one of:
+        installation - airly installation with given id
+        point - values interpolated by airly for lat, lng
+        closest - installation closest to lat, lng, picked by airly on every poll
+        fused - values of many sources merged per pollutant, installationId is the sources group name
+    """
+
+    def __init__(self, index, installationId, base, label=False, kind="installation", lat=None, lng=None):
+        self.index = index
+        self.id = installationId
+        self.kind = kind
+        self.lat = lat
+        self.lng = lng
+        # station devices use units base + UNIT_* constant
+        self.base = base
+        # append station name to device names when polling many stations
+        self.label = label
+        self.fetchInfo = kind == "installation"
+        self.infoUpdated = 0
+        self.nextpoll = datetime.datetime.now()
+        # tillDateTime of the last current measurement and number of polls it did not change
+        self.tillDateTime = None
+        self.refreshAt = None
+        self.stalePolls = 0
+        self.variables = {}
+        # airly parameter name: unit of parameters without entry in MEASUREMENTS
+        self.dynamic = {}
+        # airly value name: RollingMean
+        self.rolling = {}
+        # last measurement for rules: unix time of tillDateTime and value or index name: value
+        self.measuredAt = None
+        self.values = {}
+        # fused station: Source list, fusion method, seconds to wait for sources and max age of readings
+        self.sources = []
+        self.method = None
+        self.timeout = None
+        self.maxAge = None
+
+    @property
+    def name(self):
+        if self.kind == "installation":
+            return str(self.id)
+        if self.kind == "fused":
+            return "fused %s" % self.id
+        return "%s %s, %s" % (self.kind, self.lat, self.lng)
+
+class NearestQuery:
+    """nearest:N entry of Mode2, resolved into stations on first successful poll"""
+
+    def __init__(self, index, count, lat, lng):
+        self.index = index
+        self.count = count
+        self.lat = lat
+        self.lng = lng
+        self.nextpoll = datetime.datetime.now()
+
 class BasePlugin:
     enabled = False
 
     def __init__(self):
         # Consts
-        self.version = "0.3.1"
+        self.version = "0.6.3"
         self.airly_api_user_agent = "domoticz-airly/%s" % self.version
-        # Api v2
-        self.api_v2_installation_measurements = "https://airapi.airly.eu/v2/measurements/installation"
-        self.api_v2_installation_info = "https://airapi.airly.eu/v2/installations/%(installationId)d"
+        # Api v2, paths relative to api_url option
+        self.api_v2_installation_measurements = "/v2/measurements/installation"
+        self.api_v2_installation_info = "/v2/installations/%(installationId)d"
+        self.api_v2_installations_nearest = "/v2/installations/nearest"
+        self.api_v2_point_measurements = "/v2/measurements/point"
+        self.api_v2_nearest_measurements = "/v2/measurements/nearest"
+
+        # Mode4 "key=value;key=value" options and their defaults
+        self.options = {
+            "api_url":          "https://airapi.airly.eu",
+            "connect_timeout":  10,
+            "read_timeout":     30,
+            "keepalive_idle":   60,
+            "nearest_distance": 10,
+            "quota_reserve":    0,
+            "align":            1,
+            "align_period":     60,
+            "align_retry":      5,
+            "align_jitter":     120,
+            "cache":            1,
+            "info_ttl":         7,
+            "touch_hours":      1,
+            "provision":        "reported",
+            "history":          1,
+            "history_days":     30,
+            "history_daily_days": 0,
+            "forecast":         1,
+            "metrics":          "none",
+            "breaker_threshold": 5,
+            "breaker_timeout":  300,
+            "shared_dir":       "",
+            "rolling":          1,
+            "rules":            "rules.json",
+            "fast_start":       1,
+            "sources":          "sources.json",
+        }
 
         self.airly_api_headers = {
             "User-Agent": self.airly_api_user_agent,
             "Accept": "application/json",
+            "Accept-Encoding": "gzip",
             "apikey": ""
         }
 
@@ -161,7 +1635,31 @@ class BasePlugin:
         }
 
         self.debug = False
+        # True from job submit until its result is drained in onHeartbeat
         self.inProgress = False
+        self.fetcher = FetchWorker()
+        self.client = None
+        self.quota = RateLimit()
+        self.metrics = Metrics()
+        self.backoff = Backoff()
+        self.breaker = CircuitBreaker()
+        self.cache = ResponseCache()
+        self.coordinator = None
+        self.history = None
+        # rolling means state loaded on start, station name: airly value name: RollingMean.state()
+        self.rollingState = {}
+        # state saved after last poll, see saveSnapshot
+        self.snapshot = {}
+        # sources file of fused stations, loaded with the first fused entry of Mode2
+        self.sourcesConfig = None
+        self.rules = []
+        # unit: (nValue, sValue, time) last written to the device
+        self.written = {}
+        # units of existing devices, built on start and kept up to date by createDevice/onDeviceRemoved
+        self.registry = set()
+        self.stations = []
+        # unresolved "nearest:N" entries of Mode2
+        self.queries = []
 
         # Do not change below UNIT constants!
         self.UNIT_AIR_QUALITY_INDEX     = 1
@@ -181,6 +1679,20 @@ class BasePlugin:
         self.UNIT_O3_PERCENTAGE         = 14
         self.UNIT_SO2_PERCENTAGE        = 15
         self.UNIT_CO_PERCENTAGE         = 16
+        self.UNIT_NH3                   = 17
+        self.UNIT_H2S                   = 18
+
+        self.UNIT_FORECAST_CAQI_3H      = 25
+        self.UNIT_FORECAST_CAQI_6H      = 26
+        self.UNIT_FORECAST_CAQI_12H     = 27
+        self.UNIT_FORECAST_PM25_MAX     = 28
+        self.UNIT_FORECAST_LEVEL_DROP   = 29
+
+        self.UNIT_PM25_MEAN_24H         = 30
+        self.UNIT_PM10_MEAN_24H         = 31
+        self.UNIT_CO_MEAN_8H            = 32
+        self.UNIT_PM25_EXCEEDED_DAYS    = 33
+        self.UNIT_PM10_EXCEEDED_DAYS    = 34
 
         self.UNIT_NO2                   = 21
         self.UNIT_O3                    = 22
@@ -194,34 +1706,167 @@ class BasePlugin:
         self.UNIT_SO2_NORM              = 350
         self.UNIT_CO_NORM               = 30000
 
+        # Plugin wide metrics devices, above station unit blocks
+        self.UNIT_METRICS_LATENCY       = 240
+        self.UNIT_METRICS_CONNECT       = 241
+        self.UNIT_METRICS_BYTES         = 242
+        self.UNIT_METRICS_TOO_MANY      = 243
+        self.UNIT_METRICS_QUOTA         = 244
+        self.UNIT_METRICS_FAILURES      = 245
+        self.UNIT_METRICS_SUCCESS_AGE   = 246
+
+        # switches of rules.json, plugin wide
+        self.UNIT_RULE_FIRST            = 247
+        self.UNIT_RULE_LAST             = 255
+
+        # Parameters airly adds later get units from this range, device DeviceID keeps the parameter name
+        self.UNIT_DYNAMIC_FIRST         = 35
+        self.UNIT_DYNAMIC_LAST          = 39
+        self.DYNAMIC_DEVICE_ID          = "airly:%s"
+
+        # airly value name: device unit, optional (percentage unit, norm) and converter to (nValue, sValue)
+        self.MEASUREMENTS = {
+            "PM1":          {"unit": self.UNIT_PM1},
+            "PM25":         {"unit": self.UNIT_PM25, "norm": (self.UNIT_PM25_PERCENTAGE, self.UNIT_PM25_NORM)},
+            "PM10":         {"unit": self.UNIT_PM10, "norm": (self.UNIT_PM10_PERCENTAGE, self.UNIT_PM10_NORM)},
+            "NO2":          {"unit": self.UNIT_NO2, "norm": (self.UNIT_NO2_PERCENTAGE, self.UNIT_NO2_NORM)},
+            "O3":           {"unit": self.UNIT_O3, "norm": (self.UNIT_O3_PERCENTAGE, self.UNIT_O3_NORM)},
+            "SO2":          {"unit": self.UNIT_SO2, "norm": (self.UNIT_SO2_PERCENTAGE, self.UNIT_SO2_NORM)},
+            "CO":           {"unit": self.UNIT_CO, "norm": (self.UNIT_CO_PERCENTAGE, self.UNIT_CO_NORM)},
+            "NH3":          {"unit": self.UNIT_NH3},
+            "H2S":          {"unit": self.UNIT_H2S},
+            "TEMPERATURE":  {"unit": self.UNIT_TEMPERATURE},
+            "HUMIDITY":     {"unit": self.UNIT_HUMIDITY, "convert": self.convertHumidity},
+            # in hpa + normal forecast
+            "PRESSURE":     {"unit": self.UNIT_BAROMETER, "convert": lambda value: (0, str(value) + ";0")},
+        }
+
+        # airly CAQI level: alert device level
+        self.POLLUTION_LEVELS = {
+            "VERY_LOW":     1,  # green
+            "LOW":          1,  # green
+            "MEDIUM":       2,  # yellow
+            "HIGH":         3,  # orange
+            "VERY_HIGH":    4,  # red
+            "EXTREME":      4,  # red
+            "AIRMAGEDDON":  4,  # red
+        }
+        # airly CAQI levels from the best one
+        self.LEVELS_ORDER = ["VERY_LOW", "LOW", "MEDIUM", "HIGH", "VERY_HIGH", "EXTREME", "AIRMAGEDDON"]
+
+        # airly value name: rolling window in hours, mean device unit, exceedance days device unit and its norm
+        self.ROLLING = {
+            "PM25": (24, self.UNIT_PM25_MEAN_24H, (self.UNIT_PM25_EXCEEDED_DAYS, self.UNIT_PM25_NORM)),
+            "PM10": (24, self.UNIT_PM10_MEAN_24H, (self.UNIT_PM10_EXCEEDED_DAYS, self.UNIT_PM10_NORM)),
+            "CO":   (8, self.UNIT_CO_MEAN_8H, None),
+        }
+
+        # forecast CAQI device unit: hours ahead
+        self.FORECAST_CAQI = {
+            self.UNIT_FORECAST_CAQI_3H:     3,
+            self.UNIT_FORECAST_CAQI_6H:     6,
+            self.UNIT_FORECAST_CAQI_12H:    12,
+        }
+
+        # Every station gets a block of units, station n uses units n * UNIT_BLOCK + UNIT_*
+        # Units above MAX_STATIONS * UNIT_BLOCK are left for plugin wide devices
+        self.UNIT_BLOCK                 = 40
+        self.MAX_STATIONS               = 6
+
         # Icons
         self.iconName = "airly"
 
-        self.nextpoll = datetime.datetime.now()
         return
 
 
     def onStart(self):
         Domoticz.Debug("onStart called")
+        setLanguage(Settings["Language"])
         if Parameters["Mode6"] == 'Debug':
             self.debug = True
-            Domoticz.Debugging(1)
+            setDebugging(True)
             DumpConfigToLog()
         else:
-            Domoticz.Debugging(0)
+            setDebugging(False)
 
         Domoticz.Heartbeat(20)
         self.pollinterval = int(Parameters["Mode3"]) * 60
+        self.parseOptions(Parameters.get("Mode4", ""))
+
+        self.client = HttpClient(
+            connectTimeout=self.options["connect_timeout"],
+            readTimeout=self.options["read_timeout"],
+            maxIdle=self.options["keepalive_idle"],
+            metrics=self.metrics,
+        )
+        self.breaker.threshold = self.options["breaker_threshold"]
+        self.breaker.timeout = self.options["breaker_timeout"]
+        if self.options["shared_dir"] and fcntl is None:
+            Domoticz.Error(_("Option shared_dir is not supported on this system"))
+        elif self.options["shared_dir"]:
+            try:
+                self.coordinator = Coordinator(self.options["shared_dir"], Parameters["Mode1"], Parameters.get("HardwareID", 0))
+            except OSError as e:
+                Domoticz.Error(str(e))
+        if self.coordinator is not None:
+            # responses fetched by one hardware are served to the others
+            self.cache.folder = os.path.join(self.options["shared_dir"], "cache")
+            self.cache.shared = True
+        elif self.options["cache"]:
+            self.cache.folder = os.path.join(Parameters["HomeFolder"], "cache")
+        if self.cache.folder:
+            try:
+                os.makedirs(self.cache.folder, exist_ok=True)
+            except OSError as e:
+                Domoticz.Error(str(e))
+                self.cache.folder = None
+        if self.options["history"]:
+            self.history = HistoryStore(
+                os.path.join(Parameters["HomeFolder"], "history.db"),
+                retention=self.options["history_days"],
+                dailyRetention=self.options["history_daily_days"],
+            )
+        self.fetcher.start()
 
         if self.iconName not in Images: Domoticz.Image('icons.zip').Create()
-        iconID = Images[self.iconName].ID
-
-        self.variables = {
+        self.iconID = Images[self.iconName].ID
+
+        self.registry = set(Devices.keys())
+        self.variables = {}
+        if self.options["rolling"]:
+            self.rollingState = self.loadRolling()
+        if self.options["fast_start"]:
+            self.snapshot = self.loadSnapshot()
+            self.restoreQuota()
+        self.parseStations(Parameters["Mode2"])
+        for station in self.stations:
+            self.addStation(station)
+            self.loadCachedInfo(station)
+            for source in station.sources:
+                source.start()
+        self.loadRules()
+        if self.options["metrics"] in ("devices", "all"):
+            self.variables.update(self.metricsVariables())
+        elif self.options["metrics"] not in ("none", "file"):
+            Domoticz.Error(_("Invalid value of option %(Key)s: %(Value)s") % {"Key": "metrics", "Value": self.options["metrics"]})
+        self.shareStations()
+        if self.options["provision"] == "all":
+            self.createDevice()
+        elif self.options["provision"] != "reported":
+            Domoticz.Error(_("Invalid value of option %(Key)s: %(Value)s") % {"Key": "provision", "Value": self.options["provision"]})
+
+        # stations restored from snapshot wait for their next poll, the others are fetched by the worker right away
+        self.onHeartbeat()
+
+    def stationVariables(self, station):
+        """device map of a single station, keys are UNIT_* constants"""
+
+        variables = {
             self.UNIT_AIR_QUALITY_INDEX: {
                 "Name":     _("Air Quality Index"),
                 "TypeName": "Custom",
                 "Options":  {"Custom": "1;%s" % "CAQI"},
-                "Image":    iconID,
+                "Image":    self.iconID,
                 "Used":     1,
                 "nValue":   0,
                 "sValue":   None,
@@ -230,7 +1875,7 @@ class BasePlugin:
                 "Name":     _("PM1"),
                 "TypeName": "Custom",
                 "Options":  {"Custom": "1;%s" % "µg/m³"},
-                "Image":    iconID,
+                "Image":    self.iconID,
                 "Used":     0,
                 "nValue":   0,
                 "sValue":   None,
@@ -239,7 +1884,7 @@ class BasePlugin:
                 "Name":     _("PM2.5"),
                 "TypeName": "Custom",
                 "Options":  {"Custom": "1;%s" % "µg/m³"},
-                "Image":    iconID,
+                "Image":    self.iconID,
                 "Used":     1,
                 "nValue":   0,
                 "sValue":   None,
@@ -248,7 +1893,7 @@ class BasePlugin:
                 "Name":     _("PM10"),
                 "TypeName": "Custom",
                 "Options":  {"Custom": "1;%s" % "µg/m³"},
-                "Image":    iconID,
+                "Image":    self.iconID,
                 "Used":     1,
                 "nValue":   0,
                 "sValue":   None,
@@ -372,13 +2017,398 @@ class BasePlugin:
                 "nValue": 0,
                 "sValue": None,
             },
+            self.UNIT_NH3: {
+                "Name":     _("NH₃"),
+                "TypeName": "Custom",
+                "Options":  {"Custom": "1;%s" % "µg/m³"},
+                "Used":     1,
+                "nValue":   0,
+                "sValue":   None,
+            },
+            self.UNIT_H2S: {
+                "Name":     _("H₂S"),
+                "TypeName": "Custom",
+                "Options":  {"Custom": "1;%s" % "µg/m³"},
+                "Used":     1,
+                "nValue":   0,
+                "sValue":   None,
+            },
+            self.UNIT_FORECAST_CAQI_3H: {
+                "Name":     _("Air Quality Index in 3h"),
+                "TypeName": "Custom",
+                "Options":  {"Custom": "1;%s" % "CAQI"},
+                "Image":    self.iconID,
+                "Used":     1,
+                "nValue":   0,
+                "sValue":   None,
+            },
+            self.UNIT_FORECAST_CAQI_6H: {
+                "Name":     _("Air Quality Index in 6h"),
+                "TypeName": "Custom",
+                "Options":  {"Custom": "1;%s" % "CAQI"},
+                "Image":    self.iconID,
+                "Used":     1,
+                "nValue":   0,
+                "sValue":   None,
+            },
+            self.UNIT_FORECAST_CAQI_12H: {
+                "Name":     _("Air Quality Index in 12h"),
+                "TypeName": "Custom",
+                "Options":  {"Custom": "1;%s" % "CAQI"},
+                "Image":    self.iconID,
+                "Used":     1,
+                "nValue":   0,
+                "sValue":   None,
+            },
+            self.UNIT_FORECAST_PM25_MAX: {
+                "Name":     _("PM2.5 max in 24h"),
+                "TypeName": "Custom",
+                "Options":  {"Custom": "1;%s" % "µg/m³"},
+                "Image":    self.iconID,
+                "Used":     1,
+                "nValue":   0,
+                "sValue":   None,
+            },
+            self.UNIT_FORECAST_LEVEL_DROP: {
+                "Name":     _("Hours until pollution level drops"),
+                "TypeName": "Custom",
+                "Options":  {"Custom": "1;%s" % "h"},
+                "Used":     1,
+                "nValue":   0,
+                "sValue":   None,
+            },
+            self.UNIT_PM25_MEAN_24H: {
+                "Name":     _("PM2.5 24h mean"),
+                "TypeName": "Custom",
+                "Options":  {"Custom": "1;%s" % "µg/m³"},
+                "Image":    self.iconID,
+                "Used":     1,
+                "nValue":   0,
+                "sValue":   None,
+            },
+            self.UNIT_PM10_MEAN_24H: {
+                "Name":     _("PM10 24h mean"),
+                "TypeName": "Custom",
+                "Options":  {"Custom": "1;%s" % "µg/m³"},
+                "Image":    self.iconID,
+                "Used":     1,
+                "nValue":   0,
+                "sValue":   None,
+            },
+            self.UNIT_CO_MEAN_8H: {
+                "Name":     _("CO 8h mean"),
+                "TypeName": "Custom",
+                "Options":  {"Custom": "1;%s" % "µg/m³"},
+                "Used":     1,
+                "nValue":   0,
+                "sValue":   None,
+            },
+            self.UNIT_PM25_EXCEEDED_DAYS: {
+                "Name":     _("PM2.5 norm exceeded days this year"),
+                "TypeName": "Custom",
+                "Options":  {"Custom": "1;%s" % "days"},
+                "Used":     1,
+                "nValue":   0,
+                "sValue":   None,
+            },
+            self.UNIT_PM10_EXCEEDED_DAYS: {
+                "Name":     _("PM10 norm exceeded days this year"),
+                "TypeName": "Custom",
+                "Options":  {"Custom": "1;%s" % "days"},
+                "Used":     1,
+                "nValue":   0,
+                "sValue":   None,
+            },
+        }
+
+        if station.label:
+            for item in variables.values():
+                item["Name"] = "%s (%s)" % (item["Name"], station.name)
+        return variables
+
+    def quotaStations(self):
+        """names of stations polled with the api key, airly installations of fused stations count one by one"""
+
+        names = []
+        for station in self.stations:
+            if station.kind == "fused":
+                # installation ids, the same installation polled by other hardware is counted once
+                names.extend(str(source.id) for source in station.sources if isinstance(source, AirlySource))
+            else:
+                names.append(station.name)
+        for query in self.queries:
+            names.extend("nearest %s, %s #%d" % (query.lat, query.lng, i) for i in range(query.count))
+        return names
+
+    def shareStations(self):
+        """register polled stations with the coordinator, their count splits the shared quota"""
+
+        if self.coordinator is None:
+            return
+        try:
+            self.coordinator.share(stations=self.quotaStations())
+        except OSError as e:
+            Domoticz.Error(str(e))
+
+    def metricsVariables(self):
+        """plugin wide devices of metrics option"""
+
+        def custom(name, unit):
+            return {
+                "Name":     _(name),
+                "TypeName": "Custom",
+                "Options":  {"Custom": "1;%s" % unit},
+                "Used":     1,
+                "nValue":   0,
+                "sValue":   None,
+            }
+
+        return {
+            self.UNIT_METRICS_LATENCY:      custom("API latency", "ms"),
+            self.UNIT_METRICS_CONNECT:      custom("API connect time", "ms"),
+            self.UNIT_METRICS_BYTES:        custom("API data per poll", "kB"),
+            self.UNIT_METRICS_TOO_MANY:     custom("API 429 responses", ""),
+            self.UNIT_METRICS_QUOTA:        custom("API quota remaining", ""),
+            self.UNIT_METRICS_FAILURES:     custom("Consecutive failures", ""),
+            self.UNIT_METRICS_SUCCESS_AGE:  custom("Minutes since last success", "min"),
+        }
+
+    def publishMetrics(self):
+        """metrics devices and metrics-<hardware id>.json file in plugin folder"""
+
+        if self.options["metrics"] not in ("devices", "file", "all"):
+            return
+        snapshot = self.metrics.snapshot(self.quota)
+
+        if self.options["metrics"] in ("devices", "all"):
+            values = {
+                self.UNIT_METRICS_LATENCY:      snapshot["poll_latency_ms"],
+                self.UNIT_METRICS_CONNECT:      snapshot["poll_connect_ms"],
+                self.UNIT_METRICS_BYTES:        snapshot["poll_bytes"] / 1024.0,
+                self.UNIT_METRICS_TOO_MANY:     snapshot["too_many_requests"],
+                self.UNIT_METRICS_QUOTA:        snapshot["quota_remaining_day"],
+                self.UNIT_METRICS_FAILURES:     snapshot["consecutive_failures"],
+                self.UNIT_METRICS_SUCCESS_AGE:  snapshot["last_success_age_s"] / 60,
+            }
+            for unit, value in values.items():
+                # keep last value when there were no requests since previous poll
+                if value is not None:
+                    self.variables[unit]['sValue'] = str(round(value, 1))
+
+        if self.options["metrics"] in ("file", "all"):
+            path = os.path.join(Parameters["HomeFolder"], "metrics-%s.json" % Parameters.get("HardwareID", 0))
+            try:
+                writeJsonAtomic(path, snapshot, indent=1)
+            except OSError as e:
+                Domoticz.Error(str(e))
+
+    def addStation(self, station):
+        """register station devices in the plugin unit map"""
+
+        station.variables = self.stationVariables(station)
+        if station.kind == "point":
+            station.variables[self.UNIT_STATION_LOCATION]['sValue'] = _("Values interpolated for %(Lat)s, %(Lng)s") % {
+                "Lat": station.lat,
+                "Lng": station.lng,
+            }
+        elif station.kind == "closest":
+            station.variables[self.UNIT_STATION_LOCATION]['sValue'] = _("Installation closest to %(Lat)s, %(Lng)s") % {
+                "Lat": station.lat,
+                "Lng": station.lng,
+            }
+        elif station.kind == "fused":
+            station.variables[self.UNIT_STATION_LOCATION]['sValue'] = _("Values of %(Count)d sources fused by %(Method)s") % {
+                "Count": len(station.sources),
+                "Method": station.method,
+            }
+        for unit, item in station.variables.items():
+            self.variables[station.base + unit] = item
+
+        for name, state in self.rollingState.get(station.name, {}).items():
+            if name in self.ROLLING:
+                size, unit, exceedance = self.ROLLING[name]
+                station.rolling[name] = RollingMean(size, exceedance[1] if exceedance else None)
+                station.rolling[name].restore(state)
+
+        # devices of parameters found in earlier runs
+        for unit in range(self.UNIT_DYNAMIC_FIRST, self.UNIT_DYNAMIC_LAST + 1):
+            deviceID = getattr(Devices.get(station.base + unit), "DeviceID", "")
+            if deviceID.startswith(self.DYNAMIC_DEVICE_ID % ""):
+                self.addDynamicDevice(station, unit, deviceID[len(self.DYNAMIC_DEVICE_ID % ""):])
+
+        self.restoreStation(station)
+
+    def addDynamicDevice(self, station, unit, name):
+        """device of a parameter missing in MEASUREMENTS table"""
+
+        item = {
+            "Name":     name if not station.label else "%s (%s)" % (name, station.name),
+            "TypeName": "Custom",
+            "Options":  {"Custom": "1;"},
+            "DeviceID": self.DYNAMIC_DEVICE_ID % name,
+            "Used":     1,
+            "nValue":   0,
+            "sValue":   None,
         }
+        station.variables[unit] = item
+        self.variables[station.base + unit] = item
+        station.dynamic[name] = unit
+
+    def dynamicUnit(self, station, name):
+        """unit for a new airly parameter, None when all dynamic units are taken"""
+
+        if name not in station.dynamic:
+            free = [unit for unit in range(self.UNIT_DYNAMIC_FIRST, self.UNIT_DYNAMIC_LAST + 1) if unit not in station.variables]
+            if not free:
+                return None
+            Domoticz.Log(_("New airly parameter %(Name)s, adding unit %(Unit)d") % {"Name": name, "Unit": station.base + free[0]})
+            self.addDynamicDevice(station, free[0], name)
+        return station.dynamic[name]
+
+    def infoTTL(self):
+        return self.options["info_ttl"] * 86400
+
+    def loadCachedInfo(self, station):
+        """show cached installation info right away, worker refreshes it when older than info_ttl"""
+
+        if station.kind != "installation":
+            return
+        entry = self.cache.get(self.apiUrl(self.api_v2_installation_info % {'installationId': station.id}))
+        if entry is None:
+            return
+        try:
+            self.updateInstallationInfo(station, json.loads(entry["body"]))
+        except (KeyError, TypeError, ValueError):
+            return  # Broken cache entry, fetch it again
+        station.fetchInfo = False
+        station.infoUpdated = entry.get("stored", 0)
+
+    def parseStations(self, value):
+        """Mode2 - comma separated installation ids, nearest:N, point and closest entries"""
+
+        index = 0
+        specs = [item.strip() for item in value.replace(";", ",").split(",") if item.strip()]
+        label = len(specs) > 1 or any(not spec.isdigit() for spec in specs)
+        for spec in specs:
+            if index >= self.MAX_STATIONS:
+                Domoticz.Error(_("Too many stations, only %d stations per hardware are supported") % self.MAX_STATIONS)
+                break
+            parts = spec.split(":")
+            kind = parts[0].lower()
+            try:
+                if kind == "nearest":
+                    count = min(int(parts[1]) if len(parts) > 1 else 1, self.MAX_STATIONS - index)
+                    lat, lng = self.parseLocation(parts[2:])
+                    self.queries.append(NearestQuery(index, count, lat, lng))
+                    index += count
+                elif kind in ("point", "closest"):
+                    lat, lng = self.parseLocation(parts[1:])
+                    self.stations.append(Station(index, None, index * self.UNIT_BLOCK, label, kind, lat, lng))
+                    index += 1
+                elif kind == "fused":
+                    station = self.fusedStation(index, parts[1], label)
+                    if station is not None:
+                        self.stations.append(station)
+                        index += 1
+                else:
+                    self.stations.append(Station(index, int(spec), index * self.UNIT_BLOCK, label))
+                    index += 1
+            except (ValueError, KeyError, IndexError):
+                Domoticz.Error(_("Invalid installation id: %s") % spec)
+
+    def fusedStation(self, index, group, label):
+        """station of sources group from sources file, None when the group is invalid"""
+
+        if self.sourcesConfig is None:
+            try:
+                with open(os.path.join(Parameters["HomeFolder"], self.options["sources"]), encoding="utf-8") as f:
+                    self.sourcesConfig = json.load(f)
+            except (OSError, ValueError) as e:
+                Domoticz.Error(str(e))
+                self.sourcesConfig = {}
+
+        try:
+            config = self.sourcesConfig[group]
+            lat, lng = self.parseLocation([config["lat"], config["lng"]] if "lat" in config else [])
+            station = Station(index, group, index * self.UNIT_BLOCK, label, "fused", lat, lng)
+            station.method = config.get("method", "median")
+            if station.method not in ("freshest", "median", "weighted"):
+                raise ValueError("unknown method %s" % station.method)
+            station.timeout = float(config.get("timeout", 10))
+            station.maxAge = float(config.get("max_age", 180)) * 60
+            for spec in config["sources"]:
+                kind = spec["type"]
+                if kind == "airly":
+                    station.sources.append(AirlySource(spec, station.timeout, self))
+                elif kind == "gios":
+                    station.sources.append(GiosSource(spec, station.timeout))
+                elif kind == "http":
+                    station.sources.append(HttpSource(spec, station.timeout))
+                elif kind == "mqtt" and mqtt is None:
+                    # the other sources still work
+                    Domoticz.Error(_("Source %(Name)s failed: %(Error)s") % {
+                        "Name": spec.get("name", kind),
+                        "Error": "mqtt source requires paho-mqtt package",
+                    })
+                elif kind == "mqtt":
+                    station.sources.append(MqttSource(spec, station.timeout))
+                else:
+                    raise ValueError("unknown source type %s" % kind)
+            if not station.sources:
+                raise ValueError("no sources")
+            for source in station.sources:
+                # local sensors are at home unless told otherwise
+                if isinstance(source, (HttpSource, MqttSource)) and source.lat is None:
+                    source.lat, source.lng = lat, lng
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            Domoticz.Error(_("Invalid sources of %(Name)s in %(File)s: %(Error)s") % {
+                "Name": group,
+                "File": self.options["sources"],
+                "Error": str(e),
+            })
+            return None
+        return station
+
+    def parseLocation(self, parts):
+        """lat, lng from Mode2 entry or Domoticz location settings"""
 
-        self.onHeartbeat(fetch=True)
+        if len(parts) >= 2:
+            return float(parts[0]), float(parts[1])
+        lat, lng = Settings["Location"].split(";")
+        return float(lat), float(lng)
 
     def onStop(self):
         Domoticz.Log("onStop called")
-        Domoticz.Debugging(0)
+        # request in flight ends within connect and read timeout
+        if not self.fetcher.stop(self.options["connect_timeout"] + self.options["read_timeout"]):
+            Domoticz.Error(_("Airly api request still running on stop"))
+        self.stopSources()
+        if self.client is not None:
+            self.client.close()
+        if self.history is not None:
+            self.history.close()
+        if self.options["rolling"]:
+            self.saveRolling()
+        if self.options["fast_start"]:
+            self.saveSnapshot()
+        setDebugging(False)
+
+    def stopSources(self):
+        """Domoticz unloads the plugin after onStop, threads of fused sources must be finished by then
+
+        A source waits for at most one request, so reads end within connect plus read timeout.
+        """
+
+        sources = [(station, source) for station in self.stations for source in station.sources]
+        for station, source in sources:
+            source.stopping = True
+        deadline = time.monotonic() + 2 * max([station.timeout for station, source in sources] or [0])
+        for station, source in sources:
+            if source.join(max(deadline - time.monotonic(), 0)):
+                source.stop()
+            else:
+                # closing its connection would wait for the request as well
+                Domoticz.Error(_("Source %(Name)s failed: %(Error)s") % {"Name": source.name, "Error": "still running on stop"})
 
     def onConnect(self, Status, Description):
         Domoticz.Log("onConnect called")
@@ -397,9 +2427,118 @@ class BasePlugin:
     def onDisconnect(self):
         Domoticz.Log("onDisconnect called")
 
-    def postponeNextPool(self, seconds=3600):
-        self.nextpoll = (datetime.datetime.now() + datetime.timedelta(seconds=seconds))
-        return self.nextpoll
+    def onDeviceRemoved(self, Unit):
+        Domoticz.Debug("onDeviceRemoved called for Unit " + str(Unit))
+        self.registry.discard(Unit)
+        self.written.pop(Unit, None)
+
+    def parseOptions(self, value):
+        """parse Mode4 options string, values are cast to the type of their default"""
+
+        for item in value.replace("\n", ";").split(";"):
+            if not item.strip():
+                continue
+            key, sep, val = item.partition("=")
+            key = key.strip().lower()
+            if key not in self.options:
+                Domoticz.Error(_("Unknown option: %s") % key)
+                continue
+            try:
+                self.options[key] = type(self.options[key])(val.strip())
+            except ValueError:
+                Domoticz.Error(_("Invalid value of option %(Key)s: %(Value)s") % {"Key": key, "Value": val.strip()})
+
+    def postponeNextPool(self, seconds=3600, stations=None):
+        """move next poll of given (default all) stations"""
+
+        nextpoll = (datetime.datetime.now() + datetime.timedelta(seconds=seconds))
+        for station in (self.stations + self.queries if stations is None else stations):
+            station.nextpoll = nextpoll
+        return nextpoll
+
+    def retryLater(self, key, errorClass, stations=None, minimum=0):
+        """back off stations (default all) after a failed request"""
+
+        nextpoll = self.postponeNextPool(seconds=self.backoff.delay(key, errorClass, minimum), stations=stations)
+        Domoticz.Log(_("Next poll attempt at: %s") % str(nextpoll))
+        return nextpoll
+
+    def alignNextPoll(self, station, current):
+        """schedule next poll right after airly is expected to refresh current measurements"""
+
+        try:
+            till = parseDateTime(current["tillDateTime"])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        now = datetime.datetime.now()
+        period = datetime.timedelta(minutes=self.options["align_period"])
+        if till != station.tillDateTime:
+            station.tillDateTime = till
+            station.stalePolls = 0
+            station.refreshAt = till + period + datetime.timedelta(seconds=random.uniform(0, self.options["align_jitter"]))
+            # fresh measurement, poll interval is the shortest one: first airly refresh after it
+            nextpoll = station.refreshAt
+            earliest = now + datetime.timedelta(seconds=self.quotaInterval())
+            while nextpoll < earliest:
+                nextpoll += period
+        else:
+            # measurement not refreshed yet, retry briefly, may be sooner than poll interval
+            station.stalePolls += 1
+            retry = min(self.options["align_retry"] * 60 * 2 ** max(station.stalePolls - 1, 0), self.pollinterval)
+            # refreshAt is unknown when tillDateTime came from a snapshot without it
+            nextpoll = max(station.refreshAt or now, now + datetime.timedelta(seconds=self.quotaInterval(retry)))
+        debug("Station %(Station)s: measurement till %(Till)s, next poll at %(Next)s", {
+            "Station": station.name,
+            "Till": till,
+            "Next": nextpoll,
+        })
+        station.nextpoll = nextpoll
+
+    def quotaInterval(self, minimum=None):
+        """poll interval spreading remaining daily quota evenly over the stations until quota reset"""
+
+        stations = len(self.quotaStations())
+        if self.coordinator is not None:
+            # quota of the api key is split between all hardware using it
+            stations = self.coordinator.sync(self.quota)
+        stations = max(stations, 1)
+
+        limitDay, remainingDay, limitMinute, remainingMinute = self.quota.snapshot()
+        interval = self.pollinterval if minimum is None else minimum
+        if remainingDay is None:
+            return interval
+
+        available = remainingDay - self.options["quota_reserve"]
+        toReset = RateLimit.secondsToReset()
+        if available <= 0:
+            interval = max(interval, toReset + 60)
+        else:
+            interval = max(interval, toReset * stations / available)
+        if remainingMinute == 0:
+            interval = max(interval, 60)
+
+        debug("Quota: %(Remaining)d of %(Limit)s requests left for today, %(Stations)d stations, next poll in %(Interval)d s", {
+            "Remaining": remainingDay,
+            "Limit": limitDay,
+            "Stations": stations,
+            "Interval": interval,
+        })
+        return interval
+
+    def quotaRetryDelay(self):
+        """seconds to wait after 429 response"""
+
+        limitDay, remainingDay, limitMinute, remainingMinute = self.quota.snapshot()
+        if remainingDay == 0:
+            # daily quota used up, start again right after reset
+            return RateLimit.secondsToReset() + 60
+        if remainingMinute == 0 or remainingDay is not None:
+            return 60
+        return 3600
+
+    def nextPoll(self):
+        return min([station.nextpoll for station in self.stations + self.queries] or [None])
 
     def createDevice(self, key=None):
         """create Domoticz virtual device"""
@@ -412,8 +2551,8 @@ class BasePlugin:
             _name = item['Name']
 
             # skip if already exists
-            if key in Devices:
-                Domoticz.Debug(_("Device Unit=%(Unit)d; Name='%(Name)s' already exists") % {'Unit': key, 'Name': _name})
+            if key in self.registry:
+                debug("Device Unit=%(Unit)d; Name='%(Name)s' already exists", {'Unit': key, 'Name': _name})
                 return
 
             try:
@@ -433,12 +2572,16 @@ class BasePlugin:
             except KeyError:
                 _image = 0
 
-            Domoticz.Debug(_("Creating device Name=%(Name)s; Unit=%(Unit)d; ; TypeName=%(TypeName)s; Used=%(Used)d") % {
-                               'Name':     _name,
-                               'Unit':     _unit,
-                               'TypeName': _typename,
-                               'Used':     _used,
-                           })
+            debug("Creating device Name=%(Name)s; Unit=%(Unit)d; ; TypeName=%(TypeName)s; Used=%(Used)d", {
+                'Name':     _name,
+                'Unit':     _unit,
+                'TypeName': _typename,
+                'Used':     _used,
+            })
+
+            _extra = {}
+            if 'DeviceID' in item:
+                _extra['DeviceID'] = item['DeviceID']
 
             Domoticz.Device(
                 Name=_name,
@@ -446,9 +2589,14 @@ class BasePlugin:
                 TypeName=_typename,
                 Image=_image,
                 Options=_options,
-                Used=_used
+                Used=_used,
+                **_extra
             ).Create()
 
+            # Domoticz does not create devices when accepting new devices is disabled
+            if _unit in Devices:
+                self.registry.add(_unit)
+
         if key:
             createSingleDevice(key)
         else:
@@ -458,196 +2606,522 @@ class BasePlugin:
 
     def onHeartbeat(self, fetch=False):
         Domoticz.Debug("onHeartbeat called")
+        self.processResults()
         now = datetime.datetime.now()
 
-        if fetch == False:
-            if self.inProgress or (now < self.nextpoll):
-                Domoticz.Debug(_("Awaiting next pool: %s") % str(self.nextpoll))
-                return
+        due = [station for station in self.stations + self.queries if fetch or now >= station.nextpoll]
+        if self.inProgress or not due:
+            debug("Awaiting next poll: %s", self.nextPoll())
+            return
 
-        # Set next pool time
-        self.postponeNextPool(seconds=self.pollinterval)
+        requests = []
+        interval = self.quotaInterval()
+        for station in due:
+            # Set next poll time
+            self.postponeNextPool(seconds=interval, stations=[station])
+            if isinstance(station, NearestQuery):
+                requests.append(("nearest", station, self.installations_nearest, (station.lat, station.lng, station.count)))
+                continue
+            if station.kind == "point":
+                requests.append(("measurement", station, self.point_measurement, (station.lat, station.lng)))
+            elif station.kind == "closest":
+                requests.append(("measurement", station, self.nearest_measurement, (station.lat, station.lng)))
+            elif station.kind == "fused":
+                requests.append(("measurement", station, self.fused_measurement, (station,)))
+            else:
+                if station.fetchInfo or time.time() - station.infoUpdated > self.infoTTL():
+                    requests.append(("info", station, self.installation_info, (station.id,)))
+                requests.append(("measurement", station, self.installation_measurement, (station.id,)))
 
-        # First call, lets query API for sensor location data
-        try:
-            if fetch:
-                res = self.installation_info(Parameters["Mode2"])
-                address = ""
-                if "street" in res["address"] and res["address"]["street"] is not None:
-                    address = res["address"]["street"]
-                    if "number" in res["address"] and res["address"]["number"] is not None:
-                        address = address + " " + res["address"]["number"]
-                if len(address) > 0:
-                    self.variables[self.UNIT_STATION_LOCATION]['sValue'] = _("%(Address)s, %(City)s<br/>Station founder: %(sensorFounder)s") % {
-                        "Address": address,
-                        "City": res["address"]["city"],
-                        "sensorFounder": res["sponsor"]["name"],
-                    }
-                else:
-                    self.variables[self.UNIT_STATION_LOCATION]['sValue'] = _("%(City)s<br/>Station founder: %(sensorFounder)s") % {
-                        "City": res["address"]["city"],
-                        "sensorFounder": res["sponsor"]["name"],
-                    }
-                self.doUpdate()
+        self.inProgress = True
+        self.fetcher.submit("fetch", self.fetchData, requests)
+
+    def fetchData(self, requests):
+        """worker thread job - run api requests in order, returns (kind, target, result, error) list"""
+
+        results = []
+        for kind, target, func, args in requests:
+            if self.fetcher.stopping.is_set():
+                break  # Plugin is stopping, results would not be applied anyway
+            try:
+                results.append((kind, target, func(*args), None))
+            except (UnauthorizedException, TooManyRequestsException) as e:
+                results.append((kind, target, None, e))
+                # api key wide errors, the remaining requests would fail the same way
+                if e.expression != 404:
+                    break
+            except Exception as e:
+                results.append((kind, target, None, e))
+        return results
+
+    def processResults(self):
+        """apply finished worker jobs, runs in the Domoticz plugin thread"""
+
+        for name, results, error in self.fetcher.poll():
+            if name != "fetch":
+                # background jobs, e.g. history store
+                if error is not None:
+                    Domoticz.Error(_("%(Job)s failed: %(Error)s") % {"Job": name, "Error": str(error)})
+                elif name == "history" and results:
+                    Domoticz.Log(_("Filled %d missing hours of measurements history") % results)
+                continue
+            self.inProgress = False
+            if error is not None:
+                Domoticz.Error(_("Unrecognized error: %s") % str(error))
+                continue
+            for kind, target, result, error in results:
+                self.metrics.polled(self.applyResult(kind, target, result, error))
+            self.evaluateRules()
+            self.publishMetrics()
+            self.doUpdate()
+            # state files survive a crash or power loss, not only a clean stop
+            if self.options["rolling"]:
+                self.saveRolling()
+            if self.options["fast_start"]:
+                self.saveSnapshot()
 
+    def applyResult(self, kind, target, result, error):
+        """update plugin state with a single api request result, returns False on failure"""
+
+        try:
+            if error is not None:
+                raise error
+            if kind == "nearest":
+                self.resolveNearest(target, result)
+            elif kind == "info":
+                self.updateInstallationInfo(target, result)
+                target.fetchInfo = False
+                target.infoUpdated = time.time()
+            else:
+                for name, message in result.get("errors", []):
+                    Domoticz.Error(_("Source %(Name)s failed: %(Error)s") % {"Name": name, "Error": message})
+                self.updateMeasurement(target, result["current"])
+                if self.options["forecast"]:
+                    self.updateForecast(target, result["current"], result.get("forecast", []))
+                if self.options["rolling"]:
+                    self.updateRolling(target, result["current"], result.get("history", []))
+                if self.rules:
+                    self.updateRuleValues(target, result["current"])
+                if self.history is not None:
+                    self.fetcher.submit("history", self.history.add, target.name, [result["current"]], result.get("history", []))
+                # fused sources refresh at their own pace
+                if self.options["align"] and target.kind != "fused":
+                    self.alignNextPoll(target, result["current"])
+            self.backoff.reset(target)
+            self.backoff.reset("api")
+            return True
+        except SensorNotFoundException as snfe:
+            Domoticz.Error(_("Sensor id (%(installation_id)s) not exists") % {'installation_id': snfe.expression})
+            self.retryLater(target, "not_found", stations=[target])
         except UnauthorizedException as ue:
             Domoticz.Error(ue.message)
-            Domoticz.Error(_("Enter correct airly API key - get one on https://developer.airly.eu"))
-            return
+            if ue.expression == 404:
+                # unknown installation, other stations are fine
+                Domoticz.Error(_("Sensor id (%(installation_id)s) not exists") % {'installation_id': target.name})
+                self.retryLater(target, "not_found", stations=[target])
+            else:
+                Domoticz.Error(_("Enter correct airly API key - get one on https://developer.airly.eu"))
+                self.retryLater("api", "unauthorized")
         except TooManyRequestsException as tmre:
             Domoticz.Error(tmre.message)
-            # postpone next pool to tomorrow
-            next_attempt = self.postponeNextPool()
-            Domoticz.Error(_("Next pool attempt at: %s") % str(next_attempt))
-            return
+            # postpone next poll until quota is back
+            self.retryLater("api", "quota", minimum=tmre.retryAfter if tmre.retryAfter is not None else self.quotaRetryDelay())
+        except CircuitOpenException as coe:
+            # request was not sent, failing endpoint gets probed by a single request
+            retryAt = self.breaker.retryAt(coe.expression)
+            Domoticz.Log(_("Airly api %(Endpoint)s keeps failing, requests suspended until %(Time)s") % {
+                "Endpoint": coe.expression,
+                "Time": str(datetime.datetime.fromtimestamp(retryAt)),
+            })
+            self.postponeNextPool(seconds=max(retryAt - time.time(), 60), stations=[target])
         except ConnectionErrorException as cee:
             Domoticz.Error(_("Connection to airly api failed: %s") % str(cee.message))
-            return
+            self.retryLater(target, "connection", stations=[target])
+        except ApiErrorException as aee:
+            Domoticz.Error(str(aee.expression) + ": " + aee.message)
+            self.retryLater(target, "server", stations=[target], minimum=aee.retryAfter or 0)
+        except (UnicodeDecodeError, json.JSONDecodeError) as de:
+            # broken response body, retried like server errors
+            Domoticz.Error(str(de))
+            self.retryLater(target, "server", stations=[target])
         except Exception as e:
-            Domoticz.Error(e.message)
-            return
-
-        try:
-            # check if another thread is not running
-            # and time between last fetch has elapsed
-            self.inProgress = True
+            Domoticz.Error(_("Unrecognized error: %s") % str(e))
+        return False
 
-            res = self.installation_measurement(Parameters["Mode2"])
+    def resolveNearest(self, query, installations):
+        """turn nearest:N query into stations"""
 
-            # iterate through values map
-            values={}
-            for item in res["values"]:
-                try:
-                    values[item['name']] = item['value']
-                except KeyError:
-                    pass  # No key/value
+        if len(installations) == 0:
+            Domoticz.Error(_("No airly installation within %(Distance)d km from %(Lat)s, %(Lng)s") % {
+                "Distance": self.options["nearest_distance"],
+                "Lat": query.lat,
+                "Lng": query.lng,
+            })
+            return
 
-            try:
-                self.variables[self.UNIT_PM10]['sValue'] = values["PM10"]
-                self.variables[self.UNIT_PM10_PERCENTAGE]['sValue'] = str(round((values["PM10"]/self.UNIT_PM10_NORM) * 100))
-            except KeyError:
-                pass  # No pm10 value
+        self.queries.remove(query)
+        known = [station.id for station in self.stations]
+        for offset, installation in enumerate(installations[:query.count]):
+            if installation["id"] in known:
+                continue
+            index = query.index + offset
+            station = Station(index, installation["id"], index * self.UNIT_BLOCK, True)
+            Domoticz.Log(_("Station %(Index)d: installation id %(Id)d") % {"Index": index, "Id": station.id})
+            self.stations.append(station)
+            self.addStation(station)
+            # nearest response carries installation info already
+            self.updateInstallationInfo(station, installation)
+            station.fetchInfo = False
+            station.infoUpdated = time.time()
+        self.shareStations()
+
+    def updateInstallationInfo(self, station, res):
+        """build station location text from installation info"""
+
+        variables = station.variables
+        address = ""
+        if "street" in res["address"] and res["address"]["street"] is not None:
+            address = res["address"]["street"]
+            if "number" in res["address"] and res["address"]["number"] is not None:
+                address = address + " " + res["address"]["number"]
+        if len(address) > 0:
+            variables[self.UNIT_STATION_LOCATION]['sValue'] = _("%(Address)s, %(City)s<br/>Station founder: %(sensorFounder)s") % {
+                "Address": address,
+                "City": res["address"]["city"],
+                "sensorFounder": res["sponsor"]["name"],
+            }
+        else:
+            variables[self.UNIT_STATION_LOCATION]['sValue'] = _("%(City)s<br/>Station founder: %(sensorFounder)s") % {
+                "City": res["address"]["city"],
+                "sensorFounder": res["sponsor"]["name"],
+            }
 
-            try:
-                self.variables[self.UNIT_PM25]['sValue'] = values["PM25"]
-                self.variables[self.UNIT_PM25_PERCENTAGE]['sValue'] = str(round((values["PM25"] / self.UNIT_PM25_NORM) * 100))
-            except KeyError:
-                pass  # No pm25 value
+    def updateMeasurement(self, station, res):
+        """map current measurements to devices"""
 
-            try:
-                self.variables[self.UNIT_PM1]['sValue'] = values["PM1"]
-            except KeyError:
-                pass  # No pm1 value
+        variables = station.variables
 
+        # single pass through values, see MEASUREMENTS
+        for item in res["values"]:
             try:
-                self.variables[self.UNIT_NO2]['sValue'] = values["NO2"]
-                self.variables[self.UNIT_NO2_PERCENTAGE]['sValue'] = str(round((values["NO2"]/self.UNIT_NO2_NORM) * 100))
+                name = item['name']
+                value = item['value']
             except KeyError:
-                pass  # No no2 value
+                continue  # No key/value
+
+            measurement = self.MEASUREMENTS.get(name)
+            if measurement is None:
+                unit = self.dynamicUnit(station, name)
+                if unit is not None:
+                    variables[unit]['sValue'] = value
+                continue
+
+            unit = measurement["unit"]
+            if "convert" in measurement:
+                variables[unit]['nValue'], variables[unit]['sValue'] = measurement["convert"](value)
+            else:
+                variables[unit]['sValue'] = value
+            if "norm" in measurement:
+                normUnit, norm = measurement["norm"]
+                variables[normUnit]['sValue'] = str(round((value / norm) * 100))
 
-            try:
-                self.variables[self.UNIT_O3]['sValue'] = values["O3"]
-                self.variables[self.UNIT_O3_PERCENTAGE]['sValue'] = str(round((values["O3"]/self.UNIT_O3_NORM) * 100))
-            except KeyError:
-                pass  # No o3 value
+        try:
+            variables[self.UNIT_AIR_QUALITY_INDEX]['sValue'] = str(round(res["indexes"][0]["value"]))
+        except (KeyError, IndexError, TypeError):
+            pass  # No airQualityIndex value
 
-            try:
-                self.variables[self.UNIT_SO2]['sValue'] = values["SO2"]
-                self.variables[self.UNIT_SO2_PERCENTAGE]['sValue'] = str(round((values["SO2"]/self.UNIT_SO2_NORM) * 100))
-            except KeyError:
-                pass  # No so2 value
+        try:
+            pollutionLevel = self.POLLUTION_LEVELS.get(res["indexes"][0]["level"], 0)
+            pollutionDescription = res["indexes"][0]["description"]
+            pollutionAdvice = res["indexes"][0]["advice"]
 
-            try:
-                self.variables[self.UNIT_CO]['sValue'] = values["CO"]
-                self.variables[self.UNIT_CO_PERCENTAGE]['sValue'] = str(round((values["CO"]/self.UNIT_CO_NORM) * 100))
-            except KeyError:
-                pass  # No co value
+            variables[self.UNIT_AIR_POLLUTION_LEVEL]['nValue'] = pollutionLevel
+            variables[self.UNIT_AIR_POLLUTION_LEVEL]['sValue'] = pollutionDescription
 
-            try:
-                self.variables[self.UNIT_AIR_QUALITY_INDEX]['sValue'] = str(round(res["indexes"][0]["value"]))
-            except KeyError:
-                pass  # No airQualityIndex value
+            variables[self.UNIT_AIR_POLLUTION_ADVICE]['nValue'] = pollutionLevel
+            variables[self.UNIT_AIR_POLLUTION_ADVICE]['sValue'] = pollutionAdvice
+        except (KeyError, IndexError):
+            pass  # No air pollution value
 
-            try:
-                if res["indexes"][0]["level"] == "VERY_LOW":
-                    pollutionLevel = 1  # green
-                elif res["indexes"][0]["level"] == "LOW":
-                    pollutionLevel = 1  # green
-                elif res["indexes"][0]["level"] == "MEDIUM":
-                    pollutionLevel = 2  # yellow
-                elif res["indexes"][0]["level"] == "HIGH":
-                    pollutionLevel = 3  # orange
-                elif res["indexes"][0]["level"] == "EXTREME":
-                    pollutionLevel = 4  # red
-                elif res["indexes"][0]["level"] == "AIRMAGEDDON":
-                    pollutionLevel = 4  # red
-                else:
-                    pollutionLevel = 0
-                
-                pollutionDescription = res["indexes"][0]["description"]
-                pollutionAdvice = res["indexes"][0]["advice"]
-
-                self.variables[self.UNIT_AIR_POLLUTION_LEVEL]['nValue'] = pollutionLevel
-                self.variables[self.UNIT_AIR_POLLUTION_LEVEL]['sValue'] = pollutionDescription
-                
-                self.variables[self.UNIT_AIR_POLLUTION_ADVICE]['nValue'] = pollutionLevel
-                self.variables[self.UNIT_AIR_POLLUTION_ADVICE]['sValue'] = pollutionAdvice
-                
-            except KeyError:
-                pass  # No air pollution value
+    def updateForecast(self, station, current, forecast):
+        """forecast summary devices, computed once per fetch"""
 
+        variables = station.variables
+        now = datetime.datetime.now()
+        hours = []
+        for item in forecast:
             try:
-                humidity = int(round(values["HUMIDITY"]))
-                if humidity < 40:
-                    humidity_status = 2  # dry HUMIDITY
-                elif 40 <= humidity <= 60:
-                    humidity_status = 0  # normal HUMIDITY
-                elif 40 < humidity <= 70:
-                    humidity_status = 1  # comfortable HUMIDITY
-                else:
-                    humidity_status = 3  # wet HUMIDITY
+                caqi = [index for index in item["indexes"] if index["name"] == "AIRLY_CAQI"][0]
+                values = dict((value["name"], value["value"]) for value in item.get("values", []))
+                hours.append((parseDateTime(item["fromDateTime"]), parseDateTime(item["tillDateTime"]), caqi, values))
+            except (KeyError, IndexError, TypeError, ValueError):
+                continue  # No forecast for this hour
+        if not hours:
+            return
 
-                self.variables[self.UNIT_HUMIDITY]['nValue'] = humidity
-                self.variables[self.UNIT_HUMIDITY]['sValue'] = str(humidity_status)
-            except KeyError:
-                pass  # No humidity value
+        for unit, ahead in self.FORECAST_CAQI.items():
+            at = now + datetime.timedelta(hours=ahead)
+            for fromDateTime, tillDateTime, caqi, values in hours:
+                if fromDateTime <= at < tillDateTime and caqi["value"] is not None:
+                    variables[unit]['sValue'] = str(round(caqi["value"]))
+                    break
 
-            try:
-                self.variables[self.UNIT_TEMPERATURE]['sValue'] = values["TEMPERATURE"]
-            except KeyError:
-                pass  # No temperature value
+        pm25 = [values["PM25"] for fromDateTime, tillDateTime, caqi, values in hours
+                if values.get("PM25") is not None and fromDateTime < now + datetime.timedelta(hours=24)]
+        if pm25:
+            variables[self.UNIT_FORECAST_PM25_MAX]['sValue'] = str(round(max(pm25)))
 
+        try:
+            level = self.LEVELS_ORDER.index(current["indexes"][0]["level"])
+        except (KeyError, IndexError, ValueError):
+            return  # No current level
+        # hours until forecast level is better than current one, whole forecast horizon when it doesn't improve
+        drop = 0
+        if level > self.LEVELS_ORDER.index("LOW"):
+            drop = int(math.ceil((hours[-1][1] - now).total_seconds() / 3600))
+            for fromDateTime, tillDateTime, caqi, values in hours:
+                if caqi.get("level") in self.LEVELS_ORDER and self.LEVELS_ORDER.index(caqi["level"]) < level:
+                    drop = max(int(math.ceil((fromDateTime - now).total_seconds() / 3600)), 0)
+                    break
+        variables[self.UNIT_FORECAST_LEVEL_DROP]['sValue'] = str(drop)
+
+    def updateRolling(self, station, current, history):
+        """rolling means and exceedance days, history fills hours missed while not polling"""
+
+        values = {}
+        hours = set()
+        for measurement in list(history) + [current]:
             try:
-                # in hpa + normal forecast
-                self.variables[self.UNIT_BAROMETER]['sValue'] = str(values["PRESSURE"]) + ";0"
-            except KeyError:
-                pass  # No pressure value
+                hour = parseTimestamp(measurement["fromDateTime"]) // 3600
+            except (KeyError, TypeError, ValueError):
+                continue
+            if hour in hours:
+                continue  # Current overlaps the last history hour, hourly value wins
+            hours.add(hour)
+            for item in measurement.get("values", []):
+                if item.get("name") in self.ROLLING and item.get("value") is not None:
+                    values.setdefault(item["name"], []).append((hour, item["value"]))
+
+        variables = station.variables
+        year = str(datetime.datetime.now().year)
+        for name, (size, unit, exceedance) in self.ROLLING.items():
+            rolling = station.rolling.get(name)
+            if rolling is None:
+                rolling = station.rolling[name] = RollingMean(size, exceedance[1] if exceedance else None)
+            for hour, value in sorted(values.get(name, [])):
+                rolling.add(hour, value)
+            mean = rolling.mean()
+            if mean is not None:
+                variables[unit]['sValue'] = str(round(mean, 1))
+            if exceedance and rolling.latest is not None:
+                variables[exceedance[0]]['sValue'] = str(rolling.exceeded(year))
+
+    def updateRuleValues(self, station, current):
+        """values rules can refer to: airly values, indexes and rolling means, e.g. PM25_24H"""
 
-            self.doUpdate()
-        except SensorNotFoundException as snfe:
-            Domoticz.Error(_("Sensor id (%(installation_id)d) not exists") % {'installation_id': int(Parameters["Mode2"])})
+        try:
+            station.measuredAt = parseTimestamp(current["tillDateTime"])
+        except (KeyError, TypeError, ValueError):
+            station.measuredAt = time.time()
+        values = {}
+        for item in current.get("values", []) + current.get("indexes", []):
+            if item.get("name") is not None and isinstance(item.get("value"), (int, float)):
+                values[item["name"]] = item["value"]
+        for name, rolling in station.rolling.items():
+            mean = rolling.mean()
+            if mean is not None:
+                values["%s_%dH" % (name, rolling.size)] = mean
+        station.values = values
+
+    def loadRules(self):
+        """rules file in plugin folder, list of rules, see README"""
+
+        path = os.path.join(Parameters["HomeFolder"], self.options["rules"])
+        try:
+            with open(path, encoding="utf-8") as f:
+                specs = json.load(f)
+        except FileNotFoundError:
             return
-        except UnauthorizedException as ue:
-            Domoticz.Error(ue.message)
-            Domoticz.Error(_("Enter correct airly API key - get one on https://developer.airly.eu"))
+        except (OSError, ValueError) as e:
+            Domoticz.Error(str(e))
             return
-        except TooManyRequestsException as tmre:
-            Domoticz.Error(tmre.message)
-            # postpone next pool to tomorrow
-            next_attempt = self.postponeNextPool()
-            Domoticz.Error(_("Next pool attempt at: %s") % str(next_attempt))
+        if not isinstance(specs, list):
+            specs = [specs]
+
+        count = self.UNIT_RULE_LAST - self.UNIT_RULE_FIRST + 1
+        if len(specs) > count:
+            Domoticz.Error(_("Too many rules, only %d rules are supported") % count)
+        for index, spec in enumerate(specs[:count]):
+            unit = self.UNIT_RULE_FIRST + index
+            try:
+                rule = Rule(unit, spec)
+            except (KeyError, TypeError, ValueError) as e:
+                Domoticz.Error(_("Invalid rule %(Index)d in %(File)s: %(Error)s") % {
+                    "Index": index + 1,
+                    "File": self.options["rules"],
+                    "Error": str(e),
+                })
+                continue
+            # state survives restarts in the switch itself, trend in the snapshot
+            rule.on = getattr(Devices.get(unit), "nValue", 0) == 1
+            try:
+                last, rate = self.snapshot.get("rules", {})[rule.name]
+                rule.last = dict((station, tuple(item)) for station, item in last.items())
+                rule.rate = dict(rate)
+            except (KeyError, TypeError, ValueError, AttributeError):
+                pass  # No trend yet, or saved by previous version
+            self.rules.append(rule)
+            self.variables[unit] = {
+                "Name":     rule.name,
+                "TypeName": "Switch",
+                "Used":     1,
+                "nValue":   1 if rule.on else 0,
+                "sValue":   "On" if rule.on else "Off",
+                # switch is written only when its state flips, last seen time does not matter
+                "Touch":    0,
+            }
+
+    def evaluateRules(self):
+        """flip rule switches after new measurements were mapped"""
+
+        for rule in self.rules:
+            measured = [(station.name, station.values[rule.value], station.measuredAt) for station in self.stations
+                        if rule.value in station.values and (rule.station is None or station.name == rule.station)]
+            if not measured:
+                continue
+            on = rule.evaluate(measured)
+            if on == rule.on:
+                continue
+            rule.on = on
+            Domoticz.Log((_("Rule %s turned on") if on else _("Rule %s turned off")) % rule.name)
+            self.variables[rule.unit]['nValue'] = 1 if on else 0
+            self.variables[rule.unit]['sValue'] = "On" if on else "Off"
+
+    def snapshotPath(self):
+        return os.path.join(Parameters["HomeFolder"], "state-%s.json" % Parameters.get("HardwareID", 0))
+
+    def loadSnapshot(self):
+        try:
+            with open(self.snapshotPath(), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            Domoticz.Error(str(e))
+            return {}
+
+    def saveSnapshot(self):
+        """device values, poll schedule and quota for fast start, keyed by station name"""
+
+        stations = dict(self.snapshot.get("stations", {}))
+        for station in self.stations:
+            stations[station.name] = {
+                "variables": dict((unit, [item["nValue"], item["sValue"]]) for unit, item in station.variables.items()
+                                  if item["sValue"] is not None),
+                "nextpoll": time.mktime(station.nextpoll.timetuple()),
+                "tillDateTime": time.mktime(station.tillDateTime.timetuple()) if station.tillDateTime else None,
+                "refreshAt": time.mktime(station.refreshAt.timetuple()) if station.refreshAt else None,
+                "stalePolls": station.stalePolls,
+                "fetchInfo": station.fetchInfo,
+                "infoUpdated": station.infoUpdated,
+                "measuredAt": station.measuredAt,
+                "values": station.values,
+            }
+        self.snapshot = {
+            "saved": time.time(),
+            "quota": [self.quota.snapshot(), self.quota.updated],
+            "stations": stations,
+            "rules": dict((rule.name, [rule.last, rule.rate]) for rule in self.rules),
+        }
+        try:
+            writeJsonAtomic(self.snapshotPath(), self.snapshot)
+        except OSError as e:
+            Domoticz.Error(str(e))
+
+    def restoreQuota(self):
+        """quota reported before restart, only for the current airly day"""
+
+        try:
+            snapshot, updated = self.snapshot["quota"]
+        except (KeyError, TypeError, ValueError):
             return
-        except ConnectionErrorException as cee:
-            Domoticz.Error(_("Connection to airly api failed: %s") % str(cee.message))
+        if updated and datetime.datetime.utcfromtimestamp(updated).date() == datetime.datetime.utcnow().date():
+            self.quota.merge(tuple(snapshot), updated)
+
+    def restoreStation(self, station):
+        """last values and next poll of station from snapshot, station is polled on schedule instead of on start"""
+
+        state = self.snapshot.get("stations", {}).get(station.name)
+        if not state:
             return
-        except Exception as e:
-            Domoticz.Error(_("Unrecognized error: %s") % str(e))
-        finally:
-            self.inProgress = False
+        try:
+            for unit, (nValue, sValue) in state["variables"].items():
+                item = station.variables.get(int(unit))
+                if item is not None and item["sValue"] is None:
+                    item["nValue"], item["sValue"] = nValue, sValue
+            # never later than a regular poll, poll interval may have been shortened
+            now = datetime.datetime.now()
+            nextpoll = datetime.datetime.fromtimestamp(state["nextpoll"])
+            station.nextpoll = min(max(nextpoll, now), now + datetime.timedelta(seconds=self.pollinterval))
+            if state["tillDateTime"]:
+                station.tillDateTime = datetime.datetime.fromtimestamp(state["tillDateTime"])
+            if state.get("refreshAt"):
+                station.refreshAt = datetime.datetime.fromtimestamp(state["refreshAt"])
+            station.stalePolls = state.get("stalePolls", 0)
+            station.fetchInfo = station.fetchInfo and state["fetchInfo"]
+            station.infoUpdated = max(station.infoUpdated, state["infoUpdated"])
+            station.measuredAt = state["measuredAt"]
+            station.values = state["values"]
+        except (KeyError, TypeError, ValueError, OverflowError, OSError):
+            return  # Broken snapshot, station is fetched on start
+        Domoticz.Log(_("Station %(Name)s: values restored, next poll at %(Next)s") % {
+            "Name": station.name,
+            "Next": str(station.nextpoll),
+        })
+
+    def rollingPath(self):
+        return os.path.join(Parameters["HomeFolder"], "rolling-%s.json" % Parameters.get("HardwareID", 0))
+
+    def loadRolling(self):
+        """rolling means state saved on previous stop, keyed by station name"""
 
+        try:
+            with open(self.rollingPath(), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            Domoticz.Error(str(e))
+            return {}
+
+    def saveRolling(self):
+        state = dict(self.rollingState)
+        for station in self.stations:
+            if station.rolling:
+                state[station.name] = dict((name, rolling.state()) for name, rolling in station.rolling.items()
+                                           if rolling.latest is not None)
+        try:
+            writeJsonAtomic(self.rollingPath(), state)
+        except OSError as e:
+            Domoticz.Error(str(e))
+
+    def convertHumidity(self, value):
+        """humidity device keeps value in nValue and comfort status in sValue"""
+
+        humidity = int(round(value))
+        if humidity < 40:
+            humidity_status = 2  # dry HUMIDITY
+        elif 40 <= humidity <= 60:
+            humidity_status = 0  # normal HUMIDITY
+        elif 40 < humidity <= 70:
+            humidity_status = 1  # comfortable HUMIDITY
+        else:
+            humidity_status = 3  # wet HUMIDITY
+        return humidity, str(humidity_status)
 
     def doUpdate(self):
-        Domoticz.Log(_("Starting device update"))
+        now = datetime.datetime.now()
+        updated = 0
         for unit in self.variables:
             nV = self.variables[unit]['nValue']
             sV = self.variables[unit]['sValue']
@@ -658,10 +3132,47 @@ class BasePlugin:
 
             # Create device if required
             if sV:
-                self.createDevice(key=unit)
-                if unit in Devices:
-                    Domoticz.Log(_("Update unit=%d; nValue=%d; sValue=%s") % (unit, nV, sV))
+                if unit not in self.registry:
+                    self.createDevice(key=unit)
+                sV = str(sV)
+                if unit not in self.registry:
+                    continue
+                if self.changed(unit, nV, sV):
+                    debug("Update unit=%d; nValue=%d; sValue=%s", (unit, nV, sV))
                     Devices[unit].Update(nValue=nV, sValue=sV)
+                    self.written[unit] = (nV, sV, now)
+                    updated += 1
+                elif self.stale(unit, now):
+                    # same value, only last seen time is refreshed - no events and notifications
+                    debug("Touch unit=%d", unit)
+                    if hasattr(Devices[unit], "Touch"):
+                        Devices[unit].Touch()
+                    else:
+                        Devices[unit].Update(nValue=nV, sValue=sV)  # Domoticz before Touch() was added
+                    self.written[unit] = (nV, sV, now)
+        Domoticz.Log(_("Updated %(Updated)d of %(Total)d devices") % {"Updated": updated, "Total": len(self.variables)})
+
+    def changed(self, unit, nV, sV):
+        """value differs from the one in device"""
+
+        if unit not in self.written:
+            # first update after start, compare with value stored by Domoticz
+            try:
+                lastUpdate = datetime.datetime.strptime(Devices[unit].LastUpdate, "%Y-%m-%d %H:%M:%S")
+            except (AttributeError, TypeError, ValueError):
+                return True
+            self.written[unit] = (Devices[unit].nValue, Devices[unit].sValue, lastUpdate)
+
+        lastN, lastS, lastUpdate = self.written[unit]
+        return lastN != nV or lastS != sV
+
+    def stale(self, unit, now):
+        """unchanged device was not touched for touch_hours and would time out"""
+
+        touch = self.options["touch_hours"]
+        if touch <= 0 or not self.variables[unit].get("Touch", 1):
+            return False
+        return now - self.written[unit][2] >= datetime.timedelta(hours=touch)
 
     def api_airly_headers(self):
         """return http request headers"""
@@ -673,107 +3184,262 @@ class BasePlugin:
         
         return self.airly_api_headers
 
+    def apiUrl(self, path):
+        return self.options["api_url"].rstrip("/") + path
+
+    def api_request(self, path, fresh=None, maxAge=None, sections=None):
+        """GET api path through the response cache and pooled client, returns (status, headers, decoded body)
+
+        fresh - optional check of cached decoded body, True serves it without asking the server
+        maxAge - seconds cached response is served without asking the server
+        sections - top level keys of successful response to decode, others are skipped
+        """
+
+        url = self.apiUrl(path)
+        if self.coordinator is None:
+            return self.cached_request(url, path, fresh, maxAge, sections)
+        # other hardware waiting for the same url gets the response from shared cache
+        with self.coordinator.lock(url):
+            return self.cached_request(url, path, fresh, maxAge, sections)
+
+    def cached_request(self, url, path, fresh=None, maxAge=None, sections=None):
+        decode = json.loads if sections is None else lambda text: decodeSections(text, sections)
+        entry = self.cache.get(url)
+        if entry is not None:
+            response_object = decode(entry["body"])
+            if self.cache.fresh(entry, maxAge) or (fresh is not None and fresh(response_object)):
+                return 200, {}, response_object
+
+        # circuit breaker state is kept per endpoint, not per installation
+        endpoint = path.split("?")[0].rstrip("0123456789")
+        if not self.breaker.allow(endpoint):
+            raise CircuitOpenException(endpoint, "")
+
+        headers = dict(self.api_airly_headers())
+        if entry is not None:
+            headers.update(self.cache.validators(entry))
+
+        started = time.monotonic()
+        try:
+            status, headers, response_body = self.client.request("GET", url, headers=headers)
+        except Exception as e:
+            self.metrics.request(None, time.monotonic() - started)
+            self.breaker.failure(endpoint)
+            raise ConnectionErrorException('', str(e))
+        self.metrics.request(status, time.monotonic() - started)
+        if self.quota.update(headers) and self.coordinator is not None:
+            self.coordinator.share(quota=self.quota)
+
+        if status == 304 and entry is not None:
+            self.breaker.success(endpoint)
+            self.cache.revalidated(url, entry, headers)
+            return 200, headers, response_object
+
+        # UnicodeDecodeError and JSONDecodeError are handled by applyResult in the plugin thread
+        try:
+            response_body = response_body.decode("utf-8")
+            response_object = decode(response_body) if status == 200 else json.loads(response_body)
+        except ValueError:
+            if status == 200:
+                self.breaker.failure(endpoint)
+                raise
+            # error pages are not always json
+            response_object = {}
+
+        if status >= 500:
+            self.breaker.failure(endpoint)
+        else:
+            self.breaker.success(endpoint)
+
+        if status == 200:
+            self.cache.store(url, headers, response_body)
+        return status, headers, response_object
+
+    def measurementSections(self):
+        """parts of measurement response used by enabled features"""
+
+        sections = ["current"]
+        if self.history is not None or self.options["rolling"]:
+            sections.append("history")
+        if self.options["forecast"]:
+            sections.append("forecast")
+        return sections
+
+    def measurementFresh(self, response_object):
+        """cached measurement is the newest one until airly refreshes it"""
+
+        try:
+            till = parseDateTime(response_object["current"]["tillDateTime"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        return datetime.datetime.now() < till + datetime.timedelta(minutes=self.options["align_period"])
+
     def installation_measurement(self, installation_id):
         """current sensor measurements"""
 
         installation_id = int(installation_id)
-        airly_api = urlparse(self.api_v2_installation_measurements)
         params = urlencode({
             'installationId': installation_id,
             'indexType': 'AIRLY_CAQI'
             })
-        
 
-        try:
-            conn = HTTPSConnection(airly_api.netloc)
-            conn.request(
-                method="GET",
-                url=airly_api.path + "?" + params,
-                headers=self.api_airly_headers(),
-            )
-            response = conn.getresponse()
-            response_object = {}
-            response_body = response.read()
-        except Exception as e:
-            raise ConnectionErrorException('', str(e))
+        return self.measurement(self.api_v2_installation_measurements + "?" + params, installation_id)
 
-        try:
-            response_object = json.loads(response_body.decode("utf-8"))
-        except UnicodeDecodeError as ude:
-            Domoticz.Error(str(ude.message))
-            # reset nextpool datestamp to force running in next run
-            self.postponeNextPool(seconds=0)
+    def point_measurement(self, lat, lng):
+        """current measurements interpolated for given point"""
+
+        params = urlencode({
+            'lat': lat,
+            'lng': lng,
+            'indexType': 'AIRLY_CAQI'
+            })
+
+        return self.measurement(self.api_v2_point_measurements + "?" + params, "%s, %s" % (lat, lng))
+
+    def nearest_measurement(self, lat, lng):
+        """current measurements of the installation closest to given point"""
+
+        params = urlencode({
+            'lat': lat,
+            'lng': lng,
+            'maxDistanceKM': self.options["nearest_distance"],
+            'indexType': 'AIRLY_CAQI'
+            })
+
+        return self.measurement(self.api_v2_nearest_measurements + "?" + params, "%s, %s" % (lat, lng))
+
+    def measurement(self, url, target):
+        """query one of measurements endpoints, target identifies station in errors"""
 
-        if response.status == 200:
+        status, headers, response_object = self.api_request(
+            url,
+            fresh=self.measurementFresh if self.options["align"] else None,
+            sections=self.measurementSections()
+        )
+
+        if status == 200:
             if "current" in response_object and len(response_object['current']) > 0:
-                return response_object['current']
+                # current block with history and forecast
+                return response_object
             else:
-                raise SensorNotFoundException(installation_id, "")
-            return response_object
-        elif response.status in (401, 403, 404):
+                raise SensorNotFoundException(target, "")
+        elif status in (401, 403, 404):
             raise UnauthorizedException(
-                response.status,
+                status,
                 response_object['message'] if "message" in response_object else 'UnauthorizedException'
             )
-        elif response.status == 429:
+        elif status == 429:
             raise TooManyRequestsException(
-                response.status,
-                response_object['message'] if "message" in response_object else 'TooManyRequestsException1'
+                status,
+                response_object['message'] if "message" in response_object else 'TooManyRequestsException1',
+                parseRetryAfter(headers.get("Retry-After"))
             )
         else:
-            Domoticz.Error(
-                str(response.status) + ": " +
-                response_object['message'] if "message" in response_object else 'UnknownError'
+            raise ApiErrorException(
+                status,
+                response_object['message'] if "message" in response_object else 'UnknownError',
+                parseRetryAfter(headers.get("Retry-After"))
             )
 
+    def fused_measurement(self, station):
+        """current values of all sources of fused station, merged into airly measurement response
+
+        Sources are read concurrently, the ones which fail or don't answer within station
+        timeout are reported in errors of the result. Fails with the first error when no
+        source returned usable values.
+        """
+
+        readings, errors = readSources(station.sources, station.timeout)
+        oldest = time.time() - station.maxAge
+        readings = [reading for reading in readings if reading.at >= oldest and reading.values]
+        if not readings:
+            if errors:
+                raise errors[0][1]
+            raise SensorNotFoundException(station.name, "")
+
+        at = max(reading.at for reading in readings)
+        values = fuse(readings, station.method, station.lat, station.lng)
+        # CAQI and its level texts come from the newest airly reading
+        indexes = max([reading for reading in readings if reading.indexes] or [Reading(0, {})], key=lambda reading: reading.at).indexes
+        return {
+            "current": {
+                "fromDateTime": formatTimestamp(at - 3600),
+                "tillDateTime": formatTimestamp(at),
+                "values": [{"name": name, "value": round(value, 2)} for name, value in values.items()],
+                "indexes": indexes,
+            },
+            "errors": [(name, getattr(error, "message", "") or str(error) or type(error).__name__) for name, error in errors],
+        }
+
     def installation_info(self, installation_id):
         """Station's info with coordinates, address and current pollution level"""
 
         installation_id = int(installation_id)
-        airly_api = urlparse(self.api_v2_installation_info)
 
-        try:
-            conn = HTTPSConnection(airly_api.netloc)
-            conn.request(
-                method="GET",
-                url=airly_api.path % {'installationId': installation_id},
-                headers=self.api_airly_headers(),
-            )
-            response = conn.getresponse()
-            response_object = {}
-            response_body = response.read()
-        except Exception as e:
-            raise ConnectionErrorException('', str(e))
+        status, headers, response_object = self.api_request(
+            self.api_v2_installation_info % {'installationId': installation_id},
+            maxAge=self.infoTTL()
+        )
 
-        try:
-            response_object = json.loads(response_body.decode("utf-8"))
-        except UnicodeDecodeError as ude:
-            Domoticz.Error(ude.message)
-            # reset nextpool datestamp to force running in next run
-            self.nextpoll = datetime.datetime.now()
+        if status == 200:
             return response_object
+        elif status == 301:
+            raise ApiErrorException(
+                status,
+                response_object['message'] if "message" in response_object else 'UnknownError',
+                parseRetryAfter(headers.get("Retry-After"))
+            )
+        elif status in (403, 404):
+            raise UnauthorizedException(
+                status,
+                response_object['message'] if "message" in response_object else 'UnauthorizedException'
+            )
+        elif status == 429:
+            raise TooManyRequestsException(
+                status,
+                response_object['message'] if "message" in response_object else 'TooManyRequestsException2',
+                parseRetryAfter(headers.get("Retry-After"))
+            )
+        else:
+            raise ApiErrorException(
+                status,
+                response_object['message'] if "message" in response_object else 'UnknownError',
+                parseRetryAfter(headers.get("Retry-After"))
+            )
+
+    def installations_nearest(self, lat, lng, count):
+        """installations closest to given point, with address and sponsor"""
+
+        params = urlencode({
+            'lat': lat,
+            'lng': lng,
+            'maxDistanceKM': self.options["nearest_distance"],
+            'maxResults': count,
+            })
+
+        status, headers, response_object = self.api_request(
+            self.api_v2_installations_nearest + "?" + params,
+            maxAge=self.infoTTL()
+        )
 
-        if response.status == 200:
+        if status == 200:
             return response_object
-        elif response.status == 301:
-            Domoticz.Error(
-                str(response.status) + ": " +
-                response_object['message'] if "message" in response_object else 'UnknownError'
-            )
-        elif response.status in (403, 404):
+        elif status in (401, 403, 404):
             raise UnauthorizedException(
-                response.status,
+                status,
                 response_object['message'] if "message" in response_object else 'UnauthorizedException'
             )
-        elif response.status == 429:
+        elif status == 429:
             raise TooManyRequestsException(
-                response.status,
-                response_object['message'] if "message" in response_object else 'TooManyRequestsException2'
+                status,
+                response_object['message'] if "message" in response_object else 'TooManyRequestsException3',
+                parseRetryAfter(headers.get("Retry-After"))
             )
         else:
-            Domoticz.Error(
-                str(response.status) + ": " +
-                response_object['message'] if "message" in response_object else 'UnknownError'
+            raise ApiErrorException(
+                status,
+                response_object['message'] if "message" in response_object else 'UnknownError',
+                parseRetryAfter(headers.get("Retry-After"))
             )
 
 global _plugin
@@ -807,6 +3473,10 @@ def onDisconnect():
     global _plugin
     _plugin.onDisconnect()
 
+def onDeviceRemoved(Unit):
+    global _plugin
+    _plugin.onDeviceRemoved(Unit)
+
 def onHeartbeat():
     global _plugin
     _plugin.onHeartbeat()
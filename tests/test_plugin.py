@@ -0,0 +1,370 @@
+"""
+Unit tests of plugin.py building blocks, run with: python3 -m pytest tests
+
+plugin.py is loaded with the fake Domoticz module from tools and a simulated
+clock, like tools/simulate.py does.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+
+from simulate import PLUGIN, TOOLS, SimClock, load
+
+# 2024-06-01 12:00 UTC
+START = 1717243200
+
+
+def loadPlugin(clock):
+    domoticz = load(os.path.join(TOOLS, "Domoticz.py"), "Domoticz_tests")
+    saved = sys.modules.get("Domoticz")
+    sys.modules["Domoticz"] = domoticz
+    try:
+        plugin = load(PLUGIN, "plugin_tests")
+    finally:
+        if saved is None:
+            sys.modules.pop("Domoticz", None)
+        else:
+            sys.modules["Domoticz"] = saved
+    plugin.time = clock.timeModule()
+    plugin.datetime = clock.datetimeModule()
+    return plugin
+
+
+def localMidnightHour(year, month, day):
+    """hour number (unix time / 3600) of local midnight"""
+
+    return int(time.mktime((year, month, day, 0, 0, 0, 0, 0, -1))) // 3600
+
+
+class PluginTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = SimClock(START)
+        self.plugin = loadPlugin(self.clock)
+
+
+class DecodeSectionsTest(PluginTestCase):
+    RESPONSE = {
+        "current": {"values": [{"name": "PM25", "value": 12.5}], "indexes": []},
+        "history": [{"values": [], "note": "} { , : \" ["}],
+        "forecast": [{"values": [{"name": "PM10", "value": 20}]}],
+    }
+
+    def testOnlyWantedSections(self):
+        text = json.dumps(self.RESPONSE)
+        self.assertEqual(self.plugin.decodeSections(text, ("current", "history")), {
+            "current": self.RESPONSE["current"],
+            "history": self.RESPONSE["history"],
+        })
+
+    def testStopsAfterLastWantedSection(self):
+        # rest of the body is not decoded, not even checked
+        text = json.dumps(self.RESPONSE)[:-40] + " not json"
+        self.assertEqual(self.plugin.decodeSections(text, ("current",)), {"current": self.RESPONSE["current"]})
+
+    def testMissingSectionsAndWhitespace(self):
+        text = '\n {\n "current" :\t{"a": 1} ,\r\n "b": [1, {"c": "}"}] \n}\n'
+        self.assertEqual(self.plugin.decodeSections(text, ("current", "forecast")), {"current": {"a": 1}})
+        self.assertEqual(self.plugin.decodeSections("{}", ("current",)), {})
+        self.assertEqual(self.plugin.decodeSections(" { } ", ("current",)), {})
+
+    def testNotAnObject(self):
+        self.assertEqual(self.plugin.decodeSections(" [1, 2]", ("current",)), [1, 2])
+        self.assertEqual(self.plugin.decodeSections('"text"', ("current",)), "text")
+
+    def testMalformed(self):
+        for text in ('{"current" 1}', '{"a": 1 "current": 2}', '{"a": 1,', '{"current": [1, }'):
+            with self.subTest(text=text):
+                with self.assertRaises(json.JSONDecodeError):
+                    self.plugin.decodeSections(text, ("current",))
+
+
+class RollingMeanTest(PluginTestCase):
+    def fill(self, rolling, hours, value):
+        for hour in hours:
+            rolling.add(hour, value)
+
+    def testCoverage(self):
+        rolling = self.plugin.RollingMean(24)
+        self.fill(rolling, range(100, 117), 10.0)
+        self.assertIsNone(rolling.mean())
+        rolling.add(117, 28.0)
+        self.assertAlmostEqual(rolling.mean(), 11.0)
+
+    def testSkippedHoursAreCleared(self):
+        rolling = self.plugin.RollingMean(24)
+        self.fill(rolling, range(0, 24), 10.0)
+        rolling.add(26, 40.0)
+        # hours 0, 1 and 2 left the window, 24 and 25 are missing
+        self.assertEqual(rolling.count, 22)
+        self.assertAlmostEqual(rolling.mean(), (21 * 10.0 + 40.0) / 22)
+        rolling.add(25, 10.0)
+        self.assertEqual(rolling.count, 23)
+
+    def testGapLongerThanWindow(self):
+        rolling = self.plugin.RollingMean(24)
+        self.fill(rolling, range(0, 24), 10.0)
+        rolling.add(100, 50.0)
+        self.assertEqual((rolling.count, rolling.total), (1, 50.0))
+        self.assertIsNone(rolling.mean())
+
+    def testOldAndRepeatedHours(self):
+        rolling = self.plugin.RollingMean(24)
+        self.fill(rolling, range(10, 34), 10.0)
+        rolling.add(9, 99.0)
+        self.assertAlmostEqual(rolling.mean(), 10.0)
+        rolling.add(33, 34.0)
+        rolling.add(33, 34.0)
+        self.assertEqual(rolling.count, 24)
+        self.assertAlmostEqual(rolling.mean(), 11.0)
+
+    def testExceedanceDays(self):
+        rolling = self.plugin.RollingMean(24, norm=50)
+        first = localMidnightHour(2024, 1, 10)
+        self.fill(rolling, range(first, first + 24), 60.0)
+        # next day only 17 hours above the norm, not enough coverage
+        self.fill(rolling, range(first + 24, first + 41), 60.0)
+        self.fill(rolling, range(first + 48, first + 72), 40.0)
+        rolling.add(first + 72, 40.0)
+        self.assertEqual(rolling.exceedances, {"2024-01-10"})
+        self.assertEqual(rolling.exceeded("2024"), 1)
+        self.assertEqual(rolling.exceeded("2023"), 0)
+
+    def testRestore(self):
+        rolling = self.plugin.RollingMean(24, norm=50)
+        self.fill(rolling, range(0, 20), 15.0)
+        rolling.exceedances = {"2022-03-01", "2023-05-01", "2024-02-01"}
+        state = json.loads(json.dumps(rolling.state()))
+
+        restored = self.plugin.RollingMean(24, norm=50)
+        restored.restore(state)
+        self.assertAlmostEqual(restored.mean(), 15.0)
+        self.assertEqual(restored.latest, 19)
+        # days before the previous year are dropped
+        self.assertEqual(restored.exceedances, {"2023-05-01", "2024-02-01"})
+        restored.add(20, 36.0)
+        self.assertAlmostEqual(restored.mean(), 16.0)
+
+        resized = self.plugin.RollingMean(8)
+        resized.restore(state)
+        self.assertEqual((resized.count, resized.latest), (0, None))
+
+
+class CircuitBreakerTest(PluginTestCase):
+    def setUp(self):
+        super().setUp()
+        self.breaker = self.plugin.CircuitBreaker(threshold=3, timeout=300, maxTimeout=1000)
+
+    def fail(self, endpoint, count):
+        for i in range(count):
+            self.breaker.failure(endpoint)
+
+    def testOpensAfterThreshold(self):
+        self.fail("measurements", 2)
+        self.assertTrue(self.breaker.allow("measurements"))
+        self.breaker.success("measurements")
+        self.fail("measurements", 2)
+        self.assertTrue(self.breaker.allow("measurements"))
+        self.breaker.failure("measurements")
+        self.assertFalse(self.breaker.allow("measurements"))
+        self.assertEqual(self.breaker.retryAt("measurements"), START + 300)
+        self.assertTrue(self.breaker.allow("installations"))
+
+    def testSingleProbe(self):
+        self.fail("measurements", 3)
+        self.clock.advance(299)
+        self.assertFalse(self.breaker.allow("measurements"))
+        self.clock.advance(1)
+        self.assertTrue(self.breaker.allow("measurements"))
+        self.assertFalse(self.breaker.allow("measurements"))
+        self.breaker.success("measurements")
+        self.assertTrue(self.breaker.allow("measurements"))
+        self.assertTrue(self.breaker.allow("measurements"))
+
+    def testFailedProbeDoublesTimeout(self):
+        self.fail("measurements", 3)
+        for timeout in (600, 1000, 1000):
+            self.clock.advance(self.breaker.retryAt("measurements") - self.clock.now)
+            self.assertTrue(self.breaker.allow("measurements"))
+            self.breaker.failure("measurements")
+            self.assertEqual(self.breaker.retryAt("measurements"), self.clock.now + timeout)
+            self.assertFalse(self.breaker.allow("measurements"))
+
+        # success starts over with the first timeout
+        self.clock.advance(1000)
+        self.assertTrue(self.breaker.allow("measurements"))
+        self.breaker.success("measurements")
+        self.fail("measurements", 3)
+        self.assertEqual(self.breaker.retryAt("measurements"), self.clock.now + 300)
+
+
+class BackoffTest(PluginTestCase):
+    def setUp(self):
+        super().setUp()
+        self.plugin.random.seed(1)
+        self.backoff = self.plugin.Backoff()
+
+    def testExponentialWithCap(self):
+        for attempt in range(30):
+            ceiling = min(120 * 2 ** attempt, 3600)
+            delay = self.backoff.delay("1000", "server")
+            self.assertGreaterEqual(delay, ceiling / 2.0)
+            self.assertLessEqual(delay, ceiling)
+
+    def testKeysAndReset(self):
+        self.backoff.delay("1000", "connection")
+        self.backoff.delay("1000", "connection")
+        self.assertLessEqual(self.backoff.delay("1001", "connection"), 60)
+        self.assertGreaterEqual(self.backoff.delay("1000", "connection"), 120)
+        self.backoff.reset("1000")
+        self.backoff.reset("unknown")
+        self.assertLessEqual(self.backoff.delay("1000", "connection"), 60)
+
+    def testMinimum(self):
+        self.assertEqual(self.backoff.delay("api", "quota", minimum=5000), 5000)
+        self.assertGreaterEqual(self.backoff.delay("api", "quota", minimum=1), 60)
+
+
+class RuleTest(PluginTestCase):
+    def evaluate(self, rule, *measured):
+        rule.on = rule.evaluate(list(measured))
+        return rule.on
+
+    def testInvalid(self):
+        for spec in (
+            {"name": "Fan", "value": "PM25"},
+            {"name": "Fan", "value": "PM25", "above": 40, "below": 50},
+            {"name": "Fan", "value": "PM25", "above": True},
+            {"name": "Fan", "value": "PM25", "rise": "5"},
+            {"name": 1, "value": "PM25", "above": 40},
+        ):
+            with self.subTest(spec=spec):
+                with self.assertRaises(ValueError):
+                    self.plugin.Rule(1, spec)
+
+    def testHysteresis(self):
+        rule = self.plugin.Rule(1, {"name": "Fan", "value": "PM25", "above": 50, "below": 40})
+        self.assertFalse(self.evaluate(rule, ("a", 50, START)))
+        self.assertTrue(self.evaluate(rule, ("a", 51, START + 3600)))
+        self.assertTrue(self.evaluate(rule, ("a", 45, START + 7200)))
+        self.assertTrue(self.evaluate(rule, ("a", 40.5, START + 10800)))
+        self.assertFalse(self.evaluate(rule, ("a", 39, START + 14400)))
+        self.assertFalse(self.evaluate(rule, ("a", 45, START + 18000)))
+
+    def testHighestStation(self):
+        rule = self.plugin.Rule(1, {"name": "Fan", "value": "PM25", "above": 50})
+        self.assertTrue(self.evaluate(rule, ("a", 10, START), ("b", 60, START)))
+        self.assertFalse(self.evaluate(rule, ("a", 10, START + 3600), ("b", 30, START + 3600)))
+
+    def testRisePerStation(self):
+        rule = self.plugin.Rule(1, {"name": "Fan", "value": "PM25", "rise": 5})
+        self.assertFalse(self.evaluate(rule, ("a", 10, START), ("b", 100, START)))
+        # rate of a station is not mixed with values of another one
+        self.assertFalse(self.evaluate(rule, ("a", 12, START + 3600), ("b", 100, START + 3600)))
+        self.assertEqual(rule.rate, {"a": 2.0, "b": 0.0})
+        self.assertTrue(self.evaluate(rule, ("a", 16, START + 5400), ("b", 99, START + 3600)))
+        self.assertEqual(rule.rate, {"a": 8.0, "b": 0.0})
+        # same measurement again keeps the rate, an older one is ignored
+        self.assertTrue(self.evaluate(rule, ("a", 16, START + 5400)))
+        self.assertTrue(self.evaluate(rule, ("a", 0, START)))
+        self.assertEqual(rule.last["a"], (START + 5400, 16))
+        self.assertFalse(self.evaluate(rule, ("a", 16, START + 9000)))
+
+    def testRiseOrAbove(self):
+        rule = self.plugin.Rule(1, {"name": "Fan", "value": "PM25", "above": 50, "below": 30, "rise": 10})
+        self.assertFalse(self.evaluate(rule, ("a", 20, START)))
+        self.assertTrue(self.evaluate(rule, ("a", 35, START + 3600)))
+        self.assertTrue(self.evaluate(rule, ("a", 31, START + 7200)))
+        self.assertFalse(self.evaluate(rule, ("a", 29, START + 10800)))
+
+
+class FuseTest(PluginTestCase):
+    def reading(self, at, values, lat=None, lng=None):
+        return self.plugin.Reading(at, values, lat=lat, lng=lng)
+
+    def testFreshest(self):
+        readings = [
+            self.reading(START - 600, {"PM25": 10, "PM10": 20}),
+            self.reading(START, {"PM25": 14}),
+            self.reading(START - 60, {"TEMPERATURE": 5}),
+        ]
+        self.assertEqual(self.plugin.fuse(readings, "freshest", 50.0, 19.9), {"PM25": 14, "PM10": 20, "TEMPERATURE": 5})
+
+    def testMedian(self):
+        readings = [self.reading(START, {"PM25": value}) for value in (30, 10, 100)]
+        self.assertEqual(self.plugin.fuse(readings, "median", 50.0, 19.9), {"PM25": 30})
+        readings.append(self.reading(START, {"PM25": 20}))
+        self.assertEqual(self.plugin.fuse(readings, "median", 50.0, 19.9), {"PM25": 25})
+        self.assertEqual(self.plugin.fuse([], "median", 50.0, 19.9), {})
+
+    def testWeighted(self):
+        # about 1.1 km and 11 km north, the one without location is left out
+        readings = [
+            self.reading(START, {"PM25": 10}, 50.01, 19.9),
+            self.reading(START, {"PM25": 110}, 50.1, 19.9),
+            self.reading(START, {"PM25": 1000}),
+        ]
+        value = self.plugin.fuse(readings, "weighted", 50.0, 19.9)["PM25"]
+        self.assertAlmostEqual(value, (10 * 100 + 110 * 1) / 101.0, delta=0.1)
+
+    def testWeightedNextDoor(self):
+        readings = [
+            self.reading(START, {"PM25": 10}, 50.0, 19.9),
+            self.reading(START, {"PM25": 30}, 50.0001, 19.9),
+        ]
+        # both closer than 100 m weigh the same
+        self.assertAlmostEqual(self.plugin.fuse(readings, "weighted", 50.0, 19.9)["PM25"], 20.0)
+
+    def testWeightedWithoutLocations(self):
+        readings = [self.reading(START, {"PM25": value}) for value in (10, 20, 60)]
+        self.assertEqual(self.plugin.fuse(readings, "weighted", 50.0, 19.9), {"PM25": 20})
+
+
+class HistoryStoreTest(PluginTestCase):
+    def setUp(self):
+        super().setUp()
+        self.folder = tempfile.TemporaryDirectory()
+        self.store = self.plugin.HistoryStore(os.path.join(self.folder.name, "history.db"), retention=0)
+
+    def tearDown(self):
+        self.store.close()
+        self.folder.cleanup()
+
+    def block(self, start, value):
+        return {
+            "fromDateTime": self.plugin.formatTimestamp(start),
+            "tillDateTime": self.plugin.formatTimestamp(start + 3600),
+            "values": [{"name": "PM25", "value": value}] if value is not None else [],
+            "indexes": [],
+        }
+
+    def rows(self, station):
+        return self.store.db.execute(
+            "SELECT time, value FROM measurements WHERE station = ? ORDER BY time", (station,)
+        ).fetchall()
+
+    def testBackfill(self):
+        hour = START // 3600 * 3600
+        current = self.block(hour, 10)
+        history = [self.block(hour - 3600 * i, 20 + i) for i in range(3, -1, -1)] + [self.block(hour - 7200 * 3, None)]
+        # history of the current hour does not replace the measurement
+        self.assertEqual(self.store.add("1000", [current], history), 3)
+        self.assertEqual(self.rows("1000"), [
+            (hour - 10800, 23), (hour - 7200, 22), (hour - 3600, 21), (hour, 10),
+        ])
+        self.assertEqual(self.store.add("1000", [current], history), 0)
+        self.assertEqual(self.store.add("1001", [], history), 4)
+
+    def testWithoutHistory(self):
+        hour = START // 3600 * 3600
+        self.assertEqual(self.store.add("1000", [self.block(hour, 10)]), 0)
+        self.assertEqual(self.store.add("1000", [self.block(hour, 12)], [self.block(hour - 3600, None)]), 0)
+        self.assertEqual(self.rows("1000"), [(hour, 12)])
+
+
+if __name__ == "__main__":
+    unittest.main()
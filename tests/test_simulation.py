@@ -0,0 +1,136 @@
+"""
+Scenarios of tools/simulate.py: hardware polling the airly api simulator for days of simulated time
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+
+from airly_simulator import AirlySimulator
+from simulate import SimClock, Simulation, stationSpecs
+
+# 2024-06-01 12:05 UTC
+START = 1717243500
+DAYS = 2
+STATIONS = 6
+
+
+class RecordingSimulator(AirlySimulator):
+    """records measurement requests per installation"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # installation id: [(unix time, status)]
+        self.installations = {}
+
+    def handle(self, method, url, headers):
+        status, responseHeaders, body = super().handle(method, url, headers)
+        parsed = urlparse(url)
+        if parsed.path.rstrip("/") == "/v2/measurements/installation":
+            installation = int(parse_qs(parsed.query)["installationId"][0])
+            with self.lock:
+                self.installations.setdefault(installation, []).append((self.clock(), status))
+        return status, responseHeaders, body
+
+
+class SimulationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix="airly-tests-")
+
+    def tearDown(self):
+        shutil.rmtree(self.home, ignore_errors=True)
+
+    def simulate(self, restarts=0, mode3=15, **kwargs):
+        clock = SimClock(START)
+        simulator = RecordingSimulator(clock=clock.time, **kwargs)
+        simulation = Simulation(stationSpecs(STATIONS), clock, simulator, os.path.join(self.home, str(restarts)), mode3)
+        simulation.run(DAYS, restarts)
+        self.assertEqual(simulation.restarts, restarts)
+        return simulation, simulator
+
+    @staticmethod
+    def errors(simulation):
+        return [text for instance in simulation.instances for text in instance.domoticz.Errors()]
+
+    @staticmethod
+    def requests(simulator, installation, status=None):
+        return len([at for at, key in simulator.installations.get(installation, []) if status is None or key == status])
+
+    def assertHourly(self, simulator, installation):
+        """airly refreshes hourly, each refresh is fetched and retries are few"""
+
+        self.assertGreaterEqual(self.requests(simulator, installation, 200), DAYS * 24 - 1)
+        self.assertLessEqual(self.requests(simulator, installation), DAYS * 26)
+
+
+class ScenarioTest(SimulationTestCase):
+    def testSteady(self):
+        simulation, simulator = self.simulate()
+        self.assertEqual(self.errors(simulation), [])
+        self.assertEqual(simulator.stats["status"], {200: simulator.stats["requests"]})
+        self.assertEqual(simulator.stats["endpoints"]["/v2/installations/{id}"], STATIONS)
+        for installation in range(1000, 1000 + STATIONS):
+            self.assertHourly(simulator, installation)
+
+    def testRestarts(self):
+        steady, steadySimulator = self.simulate()
+        simulation, simulator = self.simulate(restarts=5)
+        self.assertEqual(self.errors(simulation), [])
+        # state is restored from devices and plugin folder, no extra requests after restart
+        self.assertEqual(simulator.stats["endpoints"]["/v2/installations/{id}"], STATIONS)
+        self.assertLessEqual(simulator.stats["requests"], steadySimulator.stats["requests"] + STATIONS)
+        for installation in range(1000, 1000 + STATIONS):
+            self.assertHourly(simulator, installation)
+
+    def testUnknownInstallation(self):
+        simulation, simulator = self.simulate(unknown=[1000])
+        failed = self.requests(simulator, 1000, 404)
+        self.assertEqual(self.requests(simulator, 1000), failed)
+        # backoff from 15 minutes up to 6 hours instead of polling every 15 minutes
+        self.assertGreaterEqual(failed, 5)
+        self.assertLessEqual(failed, 25)
+        for installation in range(1001, 1000 + STATIONS):
+            self.assertHourly(simulator, installation)
+        # the only errors are about the unknown installation, its info and measurement requests
+        errors = self.errors(simulation)
+        infoFailed = simulator.stats["endpoints"]["/v2/installations/{id}"] - (STATIONS - 1)
+        self.assertEqual(sorted(set(errors)), ["Installation not found", "Sensor id (1000) not exists"])
+        self.assertEqual(len(errors), 2 * (failed + infoFailed))
+
+    def testServerErrors(self):
+        simulation, simulator = self.simulate(errorRate=0.05)
+        failed = simulator.stats["status"].get(503, 0)
+        self.assertGreater(failed, 0)
+        # each failed request is reported once and retried
+        self.assertEqual(self.errors(simulation), ["503: Service temporarily unavailable"] * failed)
+        for installation in range(1000, 1000 + STATIONS):
+            self.assertGreaterEqual(self.requests(simulator, installation, 200), DAYS * 24 - 1)
+            self.assertLessEqual(self.requests(simulator, installation), DAYS * 30)
+
+    def testQuota(self):
+        # 6 stations polled hourly need 144 requests a day, the key allows 100
+        simulation, simulator = self.simulate(dailyLimit=100)
+        self.assertEqual(self.errors(simulation), [])
+        self.assertNotIn(429, simulator.stats["status"])
+        # uses the quota instead of stopping early, start and end days are partial
+        self.assertGreaterEqual(simulator.stats["requests"], 150)
+        self.assertLessEqual(simulator.stats["requests"], (DAYS + 1) * 100)
+        for installation in range(1000, 1000 + STATIONS):
+            self.assertGreaterEqual(self.requests(simulator, installation, 200), DAYS * 12)
+
+    def testPollInterval(self):
+        # at least 3 hours between polls, every third or fourth refresh is fetched
+        simulation, simulator = self.simulate(mode3=180)
+        self.assertEqual(self.errors(simulation), [])
+        for installation in range(1000, 1000 + STATIONS):
+            polls = [at for at, status in simulator.installations[installation]]
+            self.assertGreaterEqual(len(polls), DAYS * 6)
+            self.assertGreaterEqual(min(b - a for a, b in zip(polls, polls[1:])), 180 * 60)
+
+
+if __name__ == "__main__":
+    unittest.main()
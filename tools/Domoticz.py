@@ -0,0 +1,132 @@
+"""
+Fake Domoticz module for running plugin.py outside Domoticz
+
+Provides the parts of the legacy python plugin api used by the plugin:
+logging, heartbeat, Image and Device objects. Devices and Images dicts are
+the ones injected into the plugin as globals, Parameters and Settings are
+filled by the tool driving the plugin.
+
+Every loaded copy of this module is a separate Domoticz instance, see
+tools/simulate.py.
+"""
+import datetime
+import time
+
+Parameters = {}
+Settings = {}
+Devices = {}
+Images = {}
+
+# device writes and log lines, inspected by tools
+Counters = {"Create": 0, "Update": 0, "Touch": 0, "Delete": 0}
+Messages = []
+Echo = False
+
+# tools replace the clock to move LastUpdate of devices along with simulated time
+Clock = time.time
+
+_debugging = 0
+_heartbeat = 10
+
+
+def _message(level, text):
+    Messages.append((level, text))
+    if Echo:
+        print("%s: %s" % (level, text))
+
+
+def Log(text):
+    _message("Status", text)
+
+
+def Status(text):
+    _message("Status", text)
+
+
+def Error(text):
+    _message("Error", text)
+
+
+def Debug(text):
+    if _debugging:
+        _message("Debug", text)
+
+
+def Debugging(level):
+    global _debugging
+    _debugging = level
+
+
+def Heartbeat(seconds):
+    global _heartbeat
+    _heartbeat = seconds
+
+
+def HeartbeatInterval():
+    return _heartbeat
+
+
+def Errors():
+    return [text for level, text in Messages if level == "Error"]
+
+
+class Image:
+    def __init__(self, Filename):
+        self.Filename = Filename
+        self.ID = 100 + len(Images)
+
+    def Create(self):
+        # icons.zip holds a single icon set, plugin looks it up by its key
+        Images["airly"] = self
+
+
+class Device:
+    def __init__(self, Name="", Unit=0, TypeName="", Type=0, Subtype=0, Switchtype=0,
+                 Image=0, Options=None, Used=0, DeviceID="", Description=""):
+        self.Name = Name
+        self.Unit = Unit
+        self.ID = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Image = Image
+        self.Options = Options or {}
+        self.Used = Used
+        self.DeviceID = DeviceID
+        self.Description = Description
+        self.nValue = 0
+        self.sValue = ""
+        self.LastLevel = 0
+        self.LastUpdate = None
+
+    def __str__(self):
+        return "Unit: %d, Name: '%s', nValue: %d, sValue: '%s'" % (self.Unit, self.Name, self.nValue, self.sValue)
+
+    def _touched(self):
+        self.LastUpdate = datetime.datetime.fromtimestamp(Clock()).strftime("%Y-%m-%d %H:%M:%S")
+
+    def Create(self):
+        Counters["Create"] += 1
+        Devices[self.Unit] = self
+        self._touched()
+
+    def Update(self, nValue, sValue, Image=None, SignalLevel=None, BatteryLevel=None, Options=None, Name=None, **kwargs):
+        Counters["Update"] += 1
+        self.nValue = nValue
+        self.sValue = sValue
+        if Image is not None:
+            self.Image = Image
+        if Options is not None:
+            self.Options = Options
+        if Name is not None:
+            self.Name = Name
+        self._touched()
+
+    def Touch(self):
+        Counters["Touch"] += 1
+        self._touched()
+
+    def Delete(self):
+        Counters["Delete"] += 1
+        Devices.pop(self.Unit, None)
@@ -0,0 +1,420 @@
+"""
+Offline stand-in for airapi.airly.eu
+
+Serves the v2 endpoints used by the plugin:
+    /v2/measurements/installation, /v2/measurements/point, /v2/measurements/nearest,
+    /v2/installations/{id}, /v2/installations/nearest
+
+Measurements are synthetic and deterministic (same station and hour give the
+same values) or built from responses recorded from the real api. The
+simulator enforces per api key daily and per minute quota with X-RateLimit-*
+headers, answers 401 for unknown keys, 404 for unknown installations, 304 for
+matching If-None-Match and random 5xx responses at a configurable rate.
+
+Run as a server and point the plugin to it with api_url option in Mode4:
+    python3 tools/airly_simulator.py --port 8080
+    Mode4: api_url=http://127.0.0.1:8080
+"""
+import argparse
+import calendar
+import datetime
+import gzip
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+from http.client import HTTPMessage
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+LEVELS = [
+    (25, "VERY_LOW", "#6BC926"),
+    (50, "LOW", "#D1CF1E"),
+    (75, "MEDIUM", "#EFBB0F"),
+    (87.5, "HIGH", "#EF7120"),
+    (100, "VERY_HIGH", "#EF2A36"),
+    (None, "EXTREME", "#B00057"),
+]
+
+# sub-index breakpoints of CAQI for hourly PM2.5 and PM10
+CAQI_PM25 = [(0, 0), (15, 25), (30, 50), (55, 75), (110, 100)]
+CAQI_PM10 = [(0, 0), (25, 25), (50, 50), (90, 75), (180, 100)]
+
+
+def formatTime(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def parseTime(value):
+    return calendar.timegm(datetime.datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").timetuple())
+
+
+def caqi(value, breakpoints):
+    for (lowC, lowI), (highC, highI) in zip(breakpoints, breakpoints[1:]):
+        if value <= highC:
+            return lowI + (value - lowC) * (highI - lowI) / (highC - lowC)
+    (lowC, lowI), (highC, highI) = breakpoints[-2:]
+    return highI + (value - highC) * (highI - lowI) / (highC - lowC)
+
+
+class AirlySimulator:
+    """request handler shared by the http server and the in-process client
+
+    clock - function returning unix time, simulations pass their own clock
+    latency - seconds every response is delayed, jitter adds random 0..jitter seconds
+    errorRate - fraction of requests answered with 503
+    keys - valid api keys, None accepts any non empty key
+    unknown - installation ids answered with 404
+    recordDir - folder with measurements.json, installation.json and nearest.json
+        recorded from the real api, used as templates instead of synthetic values
+    """
+
+    def __init__(self, clock=time.time, latency=0.0, jitter=0.0, errorRate=0.0,
+                 dailyLimit=1000, minuteLimit=50, keys=None, unknown=(), recordDir=None, seed=0):
+        self.clock = clock
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.dailyLimit = dailyLimit
+        self.minuteLimit = minuteLimit
+        self.keys = keys
+        self.unknown = set(unknown)
+        self.templates = self.loadTemplates(recordDir) if recordDir else {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # serialized synthetic blocks, every hour is served in up to 49 responses
+        self.blocks = {}
+        # api key -> [day, requests that day, minute, requests that minute]
+        self.usage = {}
+        self.stats = {"requests": 0, "bytes": 0, "status": {}, "endpoints": {}}
+        # freshness of served measurements: target -> last served tillDateTime
+        self.served = {}
+        self.delays = []
+
+    @staticmethod
+    def loadTemplates(folder):
+        templates = {}
+        for name in ("measurements", "installation", "nearest"):
+            try:
+                with open(os.path.join(folder, name + ".json"), encoding="utf-8") as f:
+                    templates[name] = json.load(f)
+            except (OSError, ValueError):
+                pass  # Synthetic responses for the missing ones
+        return templates
+
+    def count(self, name, key):
+        self.stats[name][key] = self.stats[name].get(key, 0) + 1
+
+    def quota(self, apikey, now):
+        """count request against key quota, returns (allowed, rate limit headers)"""
+
+        day = int(now // 86400)
+        minute = int(now // 60)
+        with self.lock:
+            usage = self.usage.setdefault(apikey, [day, 0, minute, 0])
+            if usage[0] != day:
+                usage[0:2] = [day, 0]
+            if usage[2] != minute:
+                usage[2:4] = [minute, 0]
+            allowed = usage[1] < self.dailyLimit and usage[3] < self.minuteLimit
+            if allowed:
+                usage[1] += 1
+                usage[3] += 1
+            headers = {
+                "X-RateLimit-Limit-day": str(self.dailyLimit),
+                "X-RateLimit-Remaining-day": str(max(self.dailyLimit - usage[1], 0)),
+                "X-RateLimit-Limit-minute": str(self.minuteLimit),
+                "X-RateLimit-Remaining-minute": str(max(self.minuteLimit - usage[3], 0)),
+            }
+        return allowed, headers
+
+    def handle(self, method, url, headers):
+        """returns (status, headers dict, body bytes)"""
+
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self.random.uniform(0, self.jitter))
+
+        now = self.clock()
+        url = urlparse(url)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        apikey = headers.get("apikey") or headers.get("Apikey")
+        endpoint = url.path.rstrip("/")
+        if endpoint.startswith("/v2/installations/") and endpoint[18:].isdigit():
+            endpoint = "/v2/installations/{id}"
+
+        with self.lock:
+            self.stats["requests"] += 1
+            self.count("endpoints", endpoint)
+
+        status, responseHeaders, body = self.respond(method, endpoint, url.path, query, apikey, headers, now)
+
+        if body is None:
+            body = b""
+        elif not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        if body and "gzip" in (headers.get("Accept-Encoding") or ""):
+            body = gzip.compress(body, 6)
+            responseHeaders["Content-Encoding"] = "gzip"
+        responseHeaders.setdefault("Content-Type", "application/json;charset=UTF-8")
+        responseHeaders["Content-Length"] = str(len(body))
+        with self.lock:
+            self.stats["bytes"] += len(body)
+            self.count("status", status)
+        return status, responseHeaders, body
+
+    def respond(self, method, endpoint, path, query, apikey, headers, now):
+        if method != "GET":
+            return 405, {}, {"message": "Method not allowed"}
+        if not apikey or (self.keys is not None and apikey not in self.keys):
+            return 401, {}, {"errorCode": "INVALID_API_KEY", "message": "Invalid authentication credentials"}
+
+        allowed, rateHeaders = self.quota(apikey, now)
+        if not allowed:
+            if rateHeaders["X-RateLimit-Remaining-day"] == "0":
+                rateHeaders["Retry-After"] = str(86400 - int(now) % 86400)
+            else:
+                rateHeaders["Retry-After"] = str(60 - int(now) % 60)
+            return 429, rateHeaders, {"errorCode": "TOO_MANY_REQUESTS", "message": "Rate limit exceeded"}
+        with self.lock:
+            failed = self.errorRate and self.random.random() < self.errorRate
+        if failed:
+            rateHeaders["Retry-After"] = "120"
+            return 503, rateHeaders, {"errorCode": "SERVICE_UNAVAILABLE", "message": "Service temporarily unavailable"}
+
+        try:
+            if endpoint == "/v2/measurements/installation":
+                installationId = int(query["installationId"])
+                if installationId in self.unknown:
+                    return 404, rateHeaders, {"errorCode": "INSTALLATION_NOT_FOUND", "message": "Installation not found"}
+                body = self.measurements(installationId, now, installationId)
+            elif endpoint in ("/v2/measurements/point", "/v2/measurements/nearest"):
+                lat, lng = float(query["lat"]), float(query["lng"])
+                body = self.measurements(self.pointSeed(lat, lng), now, (endpoint, lat, lng))
+            elif endpoint == "/v2/installations/{id}":
+                installationId = int(path.rstrip("/").rsplit("/", 1)[1])
+                if installationId in self.unknown:
+                    return 404, rateHeaders, {"errorCode": "INSTALLATION_NOT_FOUND", "message": "Installation not found"}
+                body = self.installation(installationId)
+            elif endpoint == "/v2/installations/nearest":
+                lat, lng = float(query["lat"]), float(query["lng"])
+                count = int(query.get("maxResults", 1))
+                seed = self.pointSeed(lat, lng)
+                if "nearest" in self.templates:
+                    body = [dict(item, id=seed + i) for i, item in enumerate(self.templates["nearest"][:count])]
+                else:
+                    body = [self.installation(seed + i, lat, lng) for i in range(count)]
+            else:
+                return 404, rateHeaders, {"errorCode": "NOT_FOUND", "message": "Not found"}
+        except (KeyError, ValueError):
+            return 400, rateHeaders, {"errorCode": "BAD_REQUEST", "message": "Invalid request parameters"}
+
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+        rateHeaders["ETag"] = etag
+        if headers.get("If-None-Match") == etag:
+            return 304, rateHeaders, None
+        return 200, rateHeaders, body
+
+    @staticmethod
+    def pointSeed(lat, lng):
+        return 100000 + int(abs(lat * 1000) + abs(lng * 1000) * 7) % 900000
+
+    def measurements(self, seed, now, target):
+        """current hour with 24h of history and forecast, encoded response body"""
+
+        hour = int(now // 3600) * 3600
+        if "measurements" in self.templates:
+            body = self.shifted(self.templates["measurements"], hour)
+            till = body["current"]["tillDateTime"]
+            body = json.dumps(body).encode("utf-8")
+        else:
+            till = formatTime(hour)
+            body = ('{"current": %s, "history": [%s], "forecast": [%s]}' % (
+                self.encodedBlock(seed, hour - 3600),
+                ", ".join(self.encodedBlock(seed, hour - 3600 * (25 - i)) for i in range(24)),
+                ", ".join(self.encodedBlock(seed, hour + 3600 * i, True) for i in range(24)),
+            )).encode("utf-8")
+
+        # how late after airly refresh the client picked up new measurements
+        with self.lock:
+            if self.served.get(target) != till:
+                self.served[target] = till
+                self.delays.append(now - parseTime(till))
+        return body
+
+    @staticmethod
+    def shifted(template, hour):
+        """recorded response moved so its current block ends at given hour"""
+
+        offset = hour - parseTime(template["current"]["tillDateTime"])
+        body = json.loads(json.dumps(template))
+        for block in [body["current"]] + body.get("history", []) + body.get("forecast", []):
+            for key in ("fromDateTime", "tillDateTime"):
+                if block.get(key):
+                    block[key] = formatTime(parseTime(block[key]) + offset)
+        return body
+
+    def encodedBlock(self, seed, start, forecast=False):
+        key = (seed, start, forecast)
+        encoded = self.blocks.get(key)
+        if encoded is None:
+            if len(self.blocks) > 100000:
+                self.blocks.clear()
+            encoded = self.blocks[key] = json.dumps(self.block(seed, start, forecast))
+        return encoded
+
+    @staticmethod
+    def block(seed, start, forecast=False):
+        """one hour of synthetic values, daily cycle with station specific phase"""
+
+        hours = start / 3600.0
+        daily = math.sin((hours + seed % 24) * math.pi / 12)
+        weekly = math.sin((hours / 24 + seed % 7) * math.pi / 3.5)
+        pm25 = round(max(2.0, 25 + 15 * daily + 10 * weekly + seed % 10), 2)
+        pm10 = round(pm25 * 1.4, 2)
+        index = round(max(caqi(pm25, CAQI_PM25), caqi(pm10, CAQI_PM10)), 2)
+        for limit, level, color in LEVELS:
+            if limit is None or index < limit:
+                break
+        block = {
+            "fromDateTime": formatTime(start),
+            "tillDateTime": formatTime(start + 3600),
+            "values": [
+                {"name": "PM25", "value": pm25},
+                {"name": "PM10", "value": pm10},
+            ],
+            "indexes": [{
+                "name": "AIRLY_CAQI",
+                "value": index,
+                "level": level,
+                "description": "Synthetic %s level." % level.lower().replace("_", " "),
+                "advice": "Simulated advice.",
+                "color": color,
+            }],
+            "standards": [
+                {"name": "WHO", "pollutant": "PM25", "limit": 15.0, "percent": round(pm25 / 15.0 * 100, 2), "averaging": "24h"},
+                {"name": "WHO", "pollutant": "PM10", "limit": 45.0, "percent": round(pm10 / 45.0 * 100, 2), "averaging": "24h"},
+            ],
+        }
+        if not forecast:
+            block["values"] = [{"name": "PM1", "value": round(pm25 * 0.65, 2)}] + block["values"] + [
+                {"name": "PRESSURE", "value": round(1013 + 8 * weekly, 2)},
+                {"name": "HUMIDITY", "value": round(min(max(60 - 25 * daily, 0), 100), 2)},
+                {"name": "TEMPERATURE", "value": round(8 + 6 * daily, 2)},
+            ]
+        return block
+
+    def installation(self, installationId, lat=None, lng=None):
+        if "installation" in self.templates:
+            body = dict(self.templates["installation"])
+            body["id"] = installationId
+            return body
+        lat = 50.06 if lat is None else lat
+        lng = 19.94 if lng is None else lng
+        return {
+            "id": installationId,
+            "location": {
+                "latitude": round(lat + (installationId % 100 - 50) / 5000.0, 6),
+                "longitude": round(lng + (installationId % 37 - 18) / 3000.0, 6),
+            },
+            "address": {
+                "country": "Poland",
+                "city": "Simulated",
+                "street": "Sensor street",
+                "number": str(installationId),
+                "displayAddress1": "Simulated",
+                "displayAddress2": "Sensor street %d" % installationId,
+            },
+            "elevation": 220.0,
+            "airly": True,
+            "sponsor": {"id": 1, "name": "Simulator", "description": "Airly API simulator", "logo": "", "link": None},
+        }
+
+
+class SimulatorClient:
+    """in-process replacement of plugin HttpClient, no sockets involved"""
+
+    def __init__(self, simulator, metrics=None, **kwargs):
+        self.simulator = simulator
+        self.metrics = metrics
+
+    def request(self, method, url, headers=None):
+        # nothing is transferred, skip compression
+        headers = dict((name, value) for name, value in (headers or {}).items() if name.lower() != "accept-encoding")
+        status, headers, body = self.simulator.handle(method, url, headers)
+        if self.metrics is not None:
+            self.metrics.received(len(body))
+        message = HTTPMessage()
+        for name, value in headers.items():
+            message[name] = value
+        return status, message, body
+
+    def close(self):
+        pass
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    simulator = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        status, headers, body = self.simulator.handle("GET", self.path, self.headers)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(simulator, host="127.0.0.1", port=0):
+    """start http server in a daemon thread, returns the server, its address is in server_address"""
+
+    handler = type("Handler", (SimulatorHandler,), {"simulator": simulator})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline airly api v2 simulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="response delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra delay in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 503 responses")
+    parser.add_argument("--daily-limit", type=int, default=1000)
+    parser.add_argument("--minute-limit", type=int, default=50)
+    parser.add_argument("--keys", default="", help="comma separated valid api keys, any key when empty")
+    parser.add_argument("--unknown", default="", help="comma separated installation ids answered with 404")
+    parser.add_argument("--record-dir", help="folder with recorded measurements.json, installation.json, nearest.json")
+    args = parser.parse_args()
+
+    simulator = AirlySimulator(
+        latency=args.latency,
+        jitter=args.jitter,
+        errorRate=args.error_rate,
+        dailyLimit=args.daily_limit,
+        minuteLimit=args.minute_limit,
+        keys=set(args.keys.split(",")) if args.keys else None,
+        unknown=[int(item) for item in args.unknown.split(",") if item],
+        recordDir=args.record_dir,
+    )
+    server = serve(simulator, args.host, args.port)
+    print("Airly api simulator listening on http://%s:%d" % server.server_address)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
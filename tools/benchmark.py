@@ -0,0 +1,285 @@
+"""
+Benchmark of the poll-to-update pipeline
+
+Runs plugin instances on the fake Domoticz module with real-size responses of
+the airly api simulator served from memory, so only plugin code is measured.
+Stages per poll of all stations:
+
+    decode     decoding measurement responses (sections used by enabled features)
+    mapping    updateMeasurement and updateForecast
+    doUpdate   doUpdate including device writes
+    writes     time spent in Devices[unit].Update
+    heartbeat  onHeartbeat end-to-end: worker requests, decode, mapping, history, doUpdate
+
+Reports median and 95th percentile latency, peak allocations (tracemalloc)
+and device updates per poll for 1, 10 and 100 stations.
+
+    python3 tools/benchmark.py
+    python3 tools/benchmark.py --save baseline.json
+    python3 tools/benchmark.py --compare baseline.json --tolerance 0.25
+"""
+import argparse
+import calendar
+import datetime
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from http.client import HTTPMessage
+from urllib.parse import urlparse, parse_qs
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, TOOLS)
+
+from airly_simulator import AirlySimulator
+from simulate import SimClock, PluginInstance, stationSpecs
+
+START = calendar.timegm((2024, 1, 15, 0, 0, 0))
+STAGES = ("decode", "mapping", "doUpdate", "writes", "heartbeat")
+
+
+class ReplayClient:
+    """plugin HttpClient serving responses prepared in advance, no work left for the request itself"""
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.responses = {}
+
+    def prepare(self, ids, apikey):
+        self.responses = {}
+        for installationId in ids:
+            for path in ("/v2/measurements/installation?installationId=%d" % installationId,
+                         "/v2/installations/%d" % installationId):
+                status, headers, body = self.simulator.handle("GET", path, {"apikey": apikey})
+                message = HTTPMessage()
+                for name, value in headers.items():
+                    message[name] = value
+                self.responses[(path.split("?")[0], installationId)] = (status, message, body)
+
+    def request(self, method, url, headers=None):
+        url = urlparse(url)
+        query = parse_qs(url.query)
+        if "installationId" in query:
+            key = (url.path, int(query["installationId"][0]))
+        else:
+            key = (url.path, int(url.path.rsplit("/", 1)[1]))
+        return self.responses[key]
+
+    def close(self):
+        pass
+
+
+class Bench:
+    def __init__(self, stations, home, mode4):
+        self.clock = SimClock(START)
+        self.simulator = AirlySimulator(clock=self.clock.time, dailyLimit=10 ** 9, minuteLimit=10 ** 9)
+        self.client = ReplayClient(self.simulator)
+        self.ids = list(range(1000, 1000 + stations))
+        self.instances = []
+        for index, mode2 in enumerate(stationSpecs(stations)):
+            folder = os.path.join(home, "%d-%d" % (stations, index))
+            os.makedirs(folder, exist_ok=True)
+            instance = PluginInstance(index, self.clock, self.simulator, folder, mode2, mode4=mode4, apikey="bench")
+            instance.module.HttpClient = lambda **kwargs: self.client
+            self.wrapUpdate(instance)
+            self.instances.append(instance)
+        self.writeTime = 0.0
+
+    def wrapUpdate(self, instance):
+        bench = self
+        device = instance.domoticz.Device
+        update = device.Update
+
+        def timedUpdate(self, *args, **kwargs):
+            started = time.perf_counter()
+            update(self, *args, **kwargs)
+            bench.writeTime += time.perf_counter() - started
+
+        device.Update = timedUpdate
+
+    def updates(self):
+        return sum(instance.domoticz.Counters["Update"] for instance in self.instances)
+
+    def nextHour(self):
+        """move to next hour, every poll sees new values"""
+
+        self.clock.advance(3600)
+        self.client.prepare(self.ids, "bench")
+        for instance in self.instances:
+            del instance.domoticz.Messages[:]
+
+    def start(self):
+        self.client.prepare(self.ids, "bench")
+        for instance in self.instances:
+            instance.start()
+        self.finish()
+
+    def finish(self):
+        for instance in self.instances:
+            instance.wait()
+            instance.heartbeat()
+            instance.wait()
+
+    def stop(self):
+        for instance in self.instances:
+            instance.stop()
+
+    def stages(self, measure):
+        """decode, mapping and doUpdate of one poll, measure(name, func) runs and records the stage"""
+
+        self.nextHour()
+        bodies = [(instance, station, self.client.responses[("/v2/measurements/installation", station.id)][2])
+                  for instance in self.instances for station in instance.plugin.stations]
+
+        decoded = measure("decode", lambda: [
+            (instance, station, instance.module.decodeSections(body.decode("utf-8"), instance.plugin.measurementSections()))
+            for instance, station, body in bodies])
+
+        def mapping():
+            for instance, station, result in decoded:
+                instance.plugin.updateMeasurement(station, result["current"])
+                if instance.plugin.options["forecast"]:
+                    instance.plugin.updateForecast(station, result["current"], result.get("forecast", []))
+        measure("mapping", mapping)
+
+        def doUpdate():
+            for instance in self.instances:
+                instance.plugin.doUpdate()
+        self.writeTime = 0.0
+        updates = self.updates()
+        measure("doUpdate", doUpdate)
+        measure("writes", lambda: self.writeTime, elapsed=self.writeTime)
+        return self.updates() - updates
+
+    def heartbeat(self, measure):
+        """one onHeartbeat cycle polling all stations"""
+
+        self.nextHour()
+
+        def cycle():
+            for instance in self.instances:
+                instance.plugin.onHeartbeat(fetch=True)
+            self.finish()
+        updates = self.updates()
+        measure("heartbeat", cycle)
+        return self.updates() - updates
+
+
+class Recorder:
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.times = dict((stage, []) for stage in STAGES)
+        self.peaks = dict((stage, []) for stage in STAGES)
+
+    def __call__(self, name, func, elapsed=None):
+        gc.collect()
+        if self.memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        result = func()
+        spent = time.perf_counter() - started
+        if self.memory:
+            self.peaks[name].append(tracemalloc.get_traced_memory()[1] - before)
+        else:
+            self.times[name].append(spent if elapsed is None else elapsed)
+        return result
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0
+
+
+def run(stations, rounds, home, mode4):
+    bench = Bench(stations, home, mode4)
+    bench.start()
+    timing = Recorder()
+    memory = Recorder(memory=True)
+    updates = []
+    try:
+        for i in range(rounds):
+            updates.append(bench.stages(timing))
+            updates.append(bench.heartbeat(timing))
+        tracemalloc.start()
+        try:
+            for i in range(max(rounds // 3, 1)):
+                bench.stages(memory)
+                bench.heartbeat(memory)
+        finally:
+            tracemalloc.stop()
+    finally:
+        bench.stop()
+
+    result = {"stations": stations, "updates": percentile(updates, 0.5), "stages": {}}
+    for stage in STAGES:
+        result["stages"][stage] = {
+            "median_ms": percentile(timing.times[stage], 0.5) * 1000,
+            "p95_ms": percentile(timing.times[stage], 0.95) * 1000,
+            "peak_kb": max(memory.peaks[stage] or [0]) / 1024.0,
+        }
+    return result
+
+
+def report(results):
+    for result in results:
+        print("%d stations, %d device updates per poll" % (result["stations"], result["updates"]))
+        print("  %-10s %10s %10s %12s %10s" % ("stage", "median ms", "p95 ms", "ms/station", "peak KB"))
+        for stage in STAGES:
+            item = result["stages"][stage]
+            print("  %-10s %10.2f %10.2f %12.3f %10.1f" % (
+                stage, item["median_ms"], item["p95_ms"], item["median_ms"] / result["stations"], item["peak_kb"]))
+
+
+def compare(results, baseline, tolerance):
+    """names of stages slower than baseline by more than tolerance"""
+
+    previous = dict((item["stations"], item) for item in baseline)
+    regressions = []
+    for result in results:
+        base = previous.get(result["stations"])
+        if base is None:
+            continue
+        for stage in STAGES:
+            now, before = result["stages"][stage]["median_ms"], base["stages"][stage]["median_ms"]
+            # sub-millisecond stages are dominated by noise
+            if before > 0 and now > 1 and now > before * (1 + tolerance):
+                regressions.append("%d stations %s: %.2f ms, baseline %.2f ms" % (result["stations"], stage, now, before))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the plugin poll-to-update pipeline")
+    parser.add_argument("--stations", default="1,10,100", help="comma separated station counts")
+    parser.add_argument("--rounds", type=int, default=15, help="timed polls per station count")
+    parser.add_argument("--mode4", default="history=0;align=0", help="plugin options")
+    parser.add_argument("--save", help="write results to json file")
+    parser.add_argument("--compare", help="baseline json file, exit with 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against baseline")
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix="airly-benchmark-")
+    try:
+        results = [run(int(count), args.rounds, home, args.mode4) for count in args.stations.split(",")]
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+    report(results)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print("REGRESSION %s" % line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
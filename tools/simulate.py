@@ -0,0 +1,297 @@
+"""
+Replay harness - runs plugin.py against the airly api simulator in simulated time
+
+Every hardware instance loads its own copy of plugin.py with its own fake
+Domoticz module (tools/Domoticz.py), so many instances run side by side in
+one process like they do in Domoticz. The plugin sees a simulated clock:
+heartbeats jump straight to the next poll. Run time is the plugin's own work
+(decoding responses, response cache and state files), about 8 station-days
+per second: a week of 60 stations takes about a minute.
+
+    python3 tools/simulate.py --stations 60 --days 7
+    python3 tools/simulate.py --mode2 "nearest:3,point" --days 2 --daily-limit 100
+    python3 tools/simulate.py --stations 12 --transport http --latency 0.05
+    python3 tools/simulate.py --stations 12 --days 2 --restarts 5
+"""
+import argparse
+import datetime
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+PLUGIN = os.path.join(os.path.dirname(TOOLS), "plugin.py")
+sys.path.insert(0, TOOLS)
+
+from airly_simulator import AirlySimulator, SimulatorClient, serve
+
+HEARTBEAT = 20
+
+
+class SimClock:
+    """unix time moved by the harness, replaces time and datetime modules of the plugin"""
+
+    def __init__(self, start):
+        self.now = start
+        self.start = start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        # real time keeps request latency measurable, simulated jumps age idle connections
+        return time.monotonic() + self.now - self.start
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def timeModule(self):
+        module = types.ModuleType("time")
+        module.__dict__.update(time.__dict__)
+        module.time = self.time
+        module.monotonic = self.monotonic
+        return module
+
+    def datetimeModule(self):
+        clock = self
+
+        class SimDateTime(datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return datetime.datetime.fromtimestamp(clock.now, tz)
+
+            @classmethod
+            def utcnow(cls):
+                return datetime.datetime.utcfromtimestamp(clock.now)
+
+        module = types.ModuleType("datetime")
+        module.__dict__.update(datetime.__dict__)
+        module.datetime = SimDateTime
+        return module
+
+
+def load(path, name):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class PluginInstance:
+    """one Domoticz hardware running the plugin"""
+
+    def __init__(self, index, clock, simulator, home, mode2, mode3=15, mode4="", apikey="simulator", transport="inprocess"):
+        self.index = index
+        self.clock = clock
+        self.simulator = simulator
+        self.transport = transport
+        self.domoticz = load(os.path.join(TOOLS, "Domoticz.py"), "Domoticz_%d" % index)
+        self.domoticz.Clock = clock.time
+        self.domoticz.Parameters.update({
+            "Key": "AIRLY",
+            "HardwareID": index + 1,
+            "HomeFolder": home + os.sep,
+            "Mode1": apikey,
+            "Mode2": mode2,
+            "Mode3": str(mode3),
+            "Mode4": mode4,
+            "Mode6": "Normal",
+        })
+        self.domoticz.Settings.update({"Language": "en", "Location": "50.06;19.94"})
+        self.load()
+
+    def load(self):
+        """fresh copy of plugin.py, devices and files in home folder are kept like in Domoticz"""
+
+        # plugin.py does "import Domoticz", hand it this instance's copy
+        saved = sys.modules.get("Domoticz")
+        sys.modules["Domoticz"] = self.domoticz
+        try:
+            self.module = load(PLUGIN, "plugin_%d" % self.index)
+        finally:
+            if saved is None:
+                sys.modules.pop("Domoticz", None)
+            else:
+                sys.modules["Domoticz"] = saved
+
+        self.module.datetime = self.clock.datetimeModule()
+        self.module.time = self.clock.timeModule()
+        if self.transport == "inprocess":
+            self.module.HttpClient = lambda **kwargs: SimulatorClient(self.simulator, **kwargs)
+        self.module.Parameters = self.domoticz.Parameters
+        self.module.Settings = self.domoticz.Settings
+        self.module.Devices = self.domoticz.Devices
+        self.module.Images = self.domoticz.Images
+        self.plugin = self.module._plugin
+
+    def start(self):
+        self.module.onStart()
+
+    def heartbeat(self):
+        self.module.onHeartbeat()
+
+    def wait(self):
+        self.plugin.fetcher.wait()
+
+    def stop(self):
+        self.module.onStop()
+
+    def restart(self):
+        """hardware restarted from Domoticz, state is left only in devices and plugin folder"""
+
+        self.wait()
+        self.stop()
+        self.load()
+        self.start()
+
+    def busy(self):
+        return self.plugin.inProgress or not self.plugin.fetcher.results.empty()
+
+
+class Simulation:
+    def __init__(self, specs, clock, simulator, home, mode3=15, mode4="", keys=0, transport="inprocess"):
+        self.clock = clock
+        self.instances = []
+        for index, mode2 in enumerate(specs):
+            folder = os.path.join(home, "hardware%d" % (index + 1))
+            os.makedirs(folder, exist_ok=True)
+            apikey = "key%d" % (index % keys if keys else index)
+            self.instances.append(PluginInstance(index, clock, simulator, folder, mode2, mode3, mode4, apikey, transport))
+        self.heartbeats = 0
+        self.restarts = 0
+
+    def run(self, days, restarts=0):
+        end = self.clock.now + days * 86400
+        # restarts spread evenly over the run, each 15 minutes after an airly refresh: the first
+        # poll after restart comes before the next refresh and sees the measurement seen before
+        restartAt = [(self.clock.now + days * 86400 * (i + 1) / (restarts + 1)) // 3600 * 3600 + 900 for i in range(restarts)]
+        for instance in self.instances:
+            instance.start()
+        while self.clock.now < end:
+            if restartAt and self.clock.now >= restartAt[0]:
+                restartAt.pop(0)
+                for instance in self.instances:
+                    instance.restart()
+                self.restarts += 1
+            for instance in self.instances:
+                instance.wait()
+            # results are applied on the next heartbeat, like in Domoticz
+            if any(instance.busy() for instance in self.instances):
+                self.clock.advance(HEARTBEAT)
+            else:
+                nextPoll = min(instance.plugin.nextPoll() or datetime.datetime.max for instance in self.instances)
+                self.clock.now = max(self.clock.now + HEARTBEAT, min([self.timestamp(nextPoll)] + restartAt[:1]))
+            for instance in self.instances:
+                instance.heartbeat()
+            self.heartbeats += 1
+        for instance in self.instances:
+            instance.wait()
+            instance.heartbeat()
+            instance.stop()
+
+    @staticmethod
+    def timestamp(value):
+        if value == datetime.datetime.max:
+            return float("inf")
+        return time.mktime(value.timetuple()) + value.microsecond / 1e6
+
+
+def stationSpecs(count, first=1000, perInstance=6):
+    ids = [str(first + i) for i in range(count)]
+    return [",".join(ids[i:i + perInstance]) for i in range(0, count, perInstance)]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def report(simulation, simulator, days, wall):
+    devices = {"Create": 0, "Update": 0, "Touch": 0}
+    errors = {}
+    for instance in simulation.instances:
+        for key in devices:
+            devices[key] += instance.domoticz.Counters[key]
+        for text in instance.domoticz.Errors():
+            errors[text] = errors.get(text, 0) + 1
+    stations = sum(len(instance.plugin.stations) for instance in simulation.instances)
+    stats = simulator.stats
+    delays = [delay / 60 for delay in simulator.delays]
+
+    print("Simulated %.1f days, %d instances, %d stations in %.2f s (%d heartbeats, %d restarts)" % (
+        days, len(simulation.instances), stations, wall, simulation.heartbeats, simulation.restarts))
+    print("Requests: %d, %.1f per station per day, %.1f MB" % (
+        stats["requests"], stats["requests"] / max(stations, 1) / days, stats["bytes"] / 1e6))
+    for endpoint, count in sorted(stats["endpoints"].items()):
+        print("  %-32s %d" % (endpoint, count))
+    print("Responses: %s" % ", ".join("%s: %d" % item for item in sorted(stats["status"].items())))
+    connects = sum(instance.plugin.metrics.connects for instance in simulation.instances)
+    if connects:
+        # http transport only, in-process client has no connections
+        print("Connections: %d for %d requests" % (connects, sum(instance.plugin.metrics.requests for instance in simulation.instances)))
+    print("Devices: %(Create)d created, %(Update)d updates, %(Touch)d touches" % devices)
+    print("New measurement picked up after refresh: median %.1f min, 95%% %.1f min, max %.1f min" % (
+        percentile(delays, 0.5), percentile(delays, 0.95), max(delays or [0])))
+    print("Errors: %d" % sum(errors.values()))
+    for text, count in sorted(errors.items(), key=lambda item: -item[1])[:10]:
+        print("  %6d  %s" % (count, text))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run plugin.py against the airly api simulator in simulated time")
+    parser.add_argument("--stations", type=int, default=6, help="installations, split into hardware instances of 6")
+    parser.add_argument("--mode2", help="Mode2 of a single hardware instead of --stations")
+    parser.add_argument("--mode3", type=int, default=15, help="poll interval in minutes")
+    parser.add_argument("--mode4", default="", help="plugin options")
+    parser.add_argument("--days", type=float, default=7)
+    parser.add_argument("--restarts", type=int, default=0, help="hardware restarts during the run")
+    parser.add_argument("--keys", type=int, default=0, help="api keys shared by instances, 0 - key per instance")
+    parser.add_argument("--transport", choices=("inprocess", "http"), default="inprocess")
+    parser.add_argument("--latency", type=float, default=0.0, help="real response delay in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 503 responses")
+    parser.add_argument("--daily-limit", type=int, default=1000)
+    parser.add_argument("--minute-limit", type=int, default=50)
+    parser.add_argument("--unknown", default="", help="comma separated installation ids answered with 404")
+    parser.add_argument("--record-dir", help="folder with recorded api responses")
+    parser.add_argument("--home", help="plugin home folder, temporary when not given")
+    parser.add_argument("--verbose", action="store_true", help="print plugin log")
+    args = parser.parse_args()
+
+    clock = SimClock(time.time())
+    simulator = AirlySimulator(
+        clock=clock.time,
+        latency=args.latency,
+        errorRate=args.error_rate,
+        dailyLimit=args.daily_limit,
+        minuteLimit=args.minute_limit,
+        unknown=[int(item) for item in args.unknown.split(",") if item],
+        recordDir=args.record_dir,
+    )
+    mode4 = args.mode4
+    if args.transport == "http":
+        server = serve(simulator)
+        mode4 = "api_url=http://%s:%d;%s" % (server.server_address + (mode4,))
+
+    home = args.home or tempfile.mkdtemp(prefix="airly-simulation-")
+    specs = [args.mode2] if args.mode2 else stationSpecs(args.stations)
+    simulation = Simulation(specs, clock, simulator, home, args.mode3, mode4, args.keys, args.transport)
+    for instance in simulation.instances:
+        instance.domoticz.Echo = args.verbose
+
+    started = time.perf_counter()
+    try:
+        simulation.run(args.days, args.restarts)
+    finally:
+        if not args.home:
+            shutil.rmtree(home, ignore_errors=True)
+    report(simulation, simulator, args.days, time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    main()